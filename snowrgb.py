@@ -20,15 +20,31 @@
 
 # Import required libraries
 import time
+# When the script started running, for --startup-trace
+STARTED = time.perf_counter()
 import random
 import sys
-try:
-    from rpi_ws281x import PixelStrip, Color
-except:
-    print("Could not load rpi_ws281x module")
 import argparse
+import array
+import atexit
+import bisect
+import contextvars
 import datetime
+import importlib
+import json
+import mmap
+import os
+import queue
+import signal
+import socket
+import struct
 import threading
+from collections import OrderedDict, deque
+
+# rpi_ws281x is only imported for the ws281x backend (see make_strip()),
+# so use the same colour packing as rpi_ws281x.Color
+def Color(red, green, blue, white=0):
+    return (white << 24) | (red << 16) | (green << 8) | blue
 
 # PIR sensor signal GPIO pin
 PIR_SENSE = 16
@@ -43,6 +59,9 @@ LED_BRIGHTNESS = 20   # Set to 0 for darkest and 255 for brightest
 LED_INVERT = False    # True to invert the signal (when using NPN transistor level shift)
 LED_CHANNEL = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
 
+# Compositor configuration:
+FRAME_HZ = 100        # Maximum number of show() calls per second for the whole chain
+
 BLACK=Color(0, 0, 0)
 WHITE=Color(255, 255, 255)
 RED=Color(255, 0, 0)
@@ -72,16 +91,279 @@ cheercolour = GREEN
 # The default configuration file path
 cfgfile = '/home/pi/snowrgb.cfg'
 
+# The last cheerlights colour received, so a restart can show it straight away
+colourfile = '/home/pi/snowrgb.colour'
+
 # Randomise things a little, otherwise start pattern is too predicatable
 random.seed()
 
-# Global variables so that threads can communicate
-insync = False
-idlemen = 0
+# Optional modules imported by lazy_import(), or None if not installed
+lazy_modules = {}
+
+def lazy_import(name):
+    # Import an optional module the first time it is needed, so startup
+    # (and anyone not using it) doesn't pay for it.
+    # Return None if it isn't installed
+    if name not in lazy_modules:
+        try:
+            lazy_modules[name] = importlib.import_module(name)
+        except ImportError:
+            lazy_modules[name] = None
+    return lazy_modules[name]
+
+# Startup
+#
+# The first frame should be lit within STARTUP_BUDGET seconds of the script
+# starting. Anything it doesn't need - letting the PIRs settle, connecting
+# to cheerlights - is started after it, in the background.
+
+STARTUP_BUDGET = 1.0     # Seconds from starting to the first frame lit
+STARTUP_STAGGER = 0.1    # Seconds between each snowman starting its demo
+
+# Set by --startup-trace to print each step of startup
+startup_trace = False
+# When the last step on the main thread finished
+startup_last = STARTED
+
+def startup_phase(name, begun=None):
+    # Note that a startup step has finished, and return the seconds since
+    # the script started. Steps in the background pass the time they began;
+    # otherwise the step began when the previous one finished.
+    global startup_last
+    now = time.perf_counter()
+    if begun is None:
+        begun = startup_last
+        startup_last = now
+    if startup_trace:
+        print("Startup %7.3fs %7.3fs  %s" % (now - STARTED, now - begun, name))
+    return now - STARTED
+
+# Clocks
+#
+# Everything that sleeps, waits for another thread or asks the time goes
+# through the global clock, so the whole program can run against a
+# VirtualClock (see --simulate) instead of the wall clock.
+
+class Clock:
+    ''' The real wall clock'''
+    def now(self):
+        return datetime.datetime.now()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def Event(self):
+        return threading.Event()
+
+    def Condition(self):
+        return threading.Condition()
+
+    def Thread(self, target, args=(), name=None):
+        return threading.Thread(target=target, args=args, name=name)
+
+    def finished(self):
+        # The wall clock never runs out
+        return False
+
+class VirtualClock:
+    ''' Simulated clock, running from datetime start to datetime end.
+        Time only moves on when the main thread and every thread started
+        with clock.Thread() are sleeping or waiting, and then it jumps
+        straight to the earliest deadline, so a whole day's schedule runs
+        as fast as the CPU allows. With speed > 0, simulated time runs at
+        most speed times faster than real time.'''
+    def __init__(self, start, end, speed=0):
+        self.start = start
+        self.end = (end - start).total_seconds()
+        self.speed = speed
+        self.elapsed = 0.0
+        self.cond = threading.Condition()
+        # Threads running on this clock, starting with the main thread
+        self.threads = 1
+        # (predicate, deadline) for each thread blocked on the clock
+        self.waiters = []
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        return self.elapsed
+
+    def finished(self):
+        return self.elapsed >= self.end
+
+    def sleep(self, secs):
+        self.block(lambda: False, secs)
+
+    def Event(self):
+        return VirtualEvent(self)
+
+    def Condition(self):
+        return VirtualCondition(self)
+
+    def Thread(self, target, args=(), name=None):
+        return VirtualThread(self, target, args, name)
+
+    def block(self, predicate, timeout=None):
+        # Wait until predicate() is true, or timeout simulated seconds pass.
+        # Return the final value of predicate()
+        with self.cond:
+            deadline = None
+            if timeout is not None:
+                deadline = self.elapsed + timeout
+            waiter = (predicate, deadline)
+            self.waiters.append(waiter)
+            try:
+                while not predicate():
+                    if deadline is not None and self.elapsed >= deadline:
+                        break
+                    if len(self.waiters) < self.threads:
+                        # Someone is still running - let them get on with it
+                        self.cond.wait()
+                    elif self.runnable():
+                        # Someone has been woken, but hasn't run yet
+                        self.cond.notify_all()
+                        self.cond.wait()
+                    else:
+                        self.advance()
+            finally:
+                self.waiters.remove(waiter)
+            return predicate()
+
+    def runnable(self):
+        # True if any blocked thread is ready to carry on
+        for predicate, deadline in self.waiters:
+            if predicate() or (deadline is not None and self.elapsed >= deadline):
+                return True
+        return False
+
+    def advance(self):
+        # Everyone is blocked - jump to the earliest deadline
+        deadlines = [deadline for predicate, deadline in self.waiters if deadline is not None]
+        if not deadlines:
+            raise RuntimeError("Simulation stuck - every thread is waiting with no timeout")
+        step = min(deadlines) - self.elapsed
+        if self.speed > 0 and step > 0:
+            time.sleep(step / self.speed)
+        self.elapsed += max(step, 0.0)
+        self.cond.notify_all()
+
+class VirtualEvent:
+    ''' threading.Event work-alike for a VirtualClock'''
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        with self.clock.cond:
+            self.flag = True
+            self.clock.cond.notify_all()
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, timeout=None):
+        return self.clock.block(lambda: self.flag, timeout)
+
+class VirtualCondition:
+    ''' threading.Condition work-alike for a VirtualClock. All virtual
+        conditions share the clock's own lock.'''
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __enter__(self):
+        self.clock.cond.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.clock.cond.release()
+
+    def wait_for(self, predicate, timeout=None):
+        return self.clock.block(predicate, timeout)
+
+    def notify_all(self):
+        self.clock.cond.notify_all()
+
+class VirtualThread(threading.Thread):
+    ''' Thread which the VirtualClock waits for before moving time on'''
+    def __init__(self, clock, target, args, name):
+        threading.Thread.__init__(self, target=target, args=args, name=name)
+        self.clock = clock
+        self.done = False
+
+    def start(self):
+        with self.clock.cond:
+            self.clock.threads += 1
+        threading.Thread.start(self)
+
+    def run(self):
+        try:
+            threading.Thread.run(self)
+        finally:
+            with self.clock.cond:
+                self.clock.threads -= 1
+                self.done = True
+                self.clock.cond.notify_all()
+
+    def join(self, timeout=None):
+        if self.clock.block(lambda: self.done, timeout):
+            threading.Thread.join(self)
+
+class AsyncClock(Clock):
+    ''' Wall clock for --asyncio, whose events and conditions are for
+        asyncio tasks. Sleeps are still real sleeps, for work done in
+        other threads.'''
+    def Event(self):
+        return AsyncEvent()
+
+    def Condition(self):
+        return asyncio.Condition()
+
+class AsyncEvent:
+    ''' asyncio.Event which can also be set from other threads.
+        Must be created in the event loop's thread.'''
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.event = asyncio.Event()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def set(self):
+        if threading.get_ident() == self.thread:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self):
+        await self.event.wait()
+        return True
+
+# The clock used by everything - replaced by a VirtualClock for --simulate
+clock = Clock()
+
+# Set to make all of the snowman threads finish
+stopping = clock.Event()
+
+# Hands the LEDs to and from the all-snowmen displays - see SyncGate
+gate = None
+
+# Set to start an all-snowmen display now (see --control)
+sync_request = clock.Event()
 
 def datenow():
     # Return the current date and time as YYYY/MM/DD HH:MMM:SS
-    return datetime.datetime.now().strftime("%F %T")
+    return clock.now().strftime("%F %T")
 
 def timestring_to_secs(timestring):
     # Convert a time string to seconds since midnight.
@@ -97,189 +379,1220 @@ def timestring_to_secs(timestring):
         timesecs = int(tvals[0]) * 3600 + int(tvals[1]) * 60  + int(tvals[2])
     return timesecs
 
-def hold_leds_add(hold_leds, baseLED, next):
-    ''' Add a new tail entry to the list of LEDs turned on,
-        so that  they can be turned off later.
-        This stores the offest including the baseLED value,
-        since the snowman being turned off will vary'''
-    if type(next) is int:
-        next = next + baseLED
-    elif type(next) is tuple:
-        next = tuple([x + baseLED for x in next])
-    hold_leds.append(next)
-    # Updates called hold_leds variable
-    # No need to return the list
-
-def hold_leds_release(hold_leds, hold_max, strip, wait_ms):
-    ''' Remove the head of the hold_leds list and turn it off.
-        Repeat until list is at max allowed length.
-        Return updated list '''
-    # If there are more than the expected number of LEDs to
-    # turn off in the list, loop through removing them.
-    # This keeps the list filled to hold_max during running,
-    # and with hold_max=0 will drain the list.
-    while len(hold_leds) > hold_max:
-        head_led = hold_leds[0]
-        hold_leds = hold_leds[1:]
-        if type(head_led) is int:
-            strip.setPixelColor(head_led, BLACK)
-            strip.show()
-        elif type(head_led) is tuple:
-            # Multiple LEDS to turn off at the same time
-            for hl in head_led:
-                strip.setPixelColor(hl, BLACK)
+# Metrics (--metrics)
+#
+# Counters and histograms, served in the Prometheus text format over HTTP
+# (or HTTP on a Unix socket). metrics is None unless --metrics is given,
+# so the code being measured only has to check that.
+
+# Upper bounds of the histogram buckets, in seconds
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# What each metric measures
+METRIC_HELP = {
+    'snowrgb_show_seconds': 'Time taken by strip.show() on each output',
+    'snowrgb_frames_committed_total': 'Frames committed by each snowman',
+    'snowrgb_frames_suppressed_total': 'Frames not sent because they had not changed, by snowman',
+    'snowrgb_sleep_overshoot_seconds': 'How late each frame deadline was met',
+    'snowrgb_frames_skipped_total': 'Frames dropped because they were already late, by pattern',
+    'snowrgb_pattern_seconds': 'Time taken by each run of a pattern',
+    'snowrgb_sync_enter_seconds': 'Time for every snowman to stop for an all-snowmen display',
+    'snowrgb_cheerlights_lag_seconds': 'Time from a cheerlights message arriving to the colour being used',
+    'snowrgb_stream_frames_total': 'Frames received by --opc',
+    'snowrgb_stream_frames_dropped_total': 'Frames received by --opc but replaced by a newer one before being shown',
+}
+
+metrics = None
+
+class Metrics:
+    ''' Counters and histograms, keyed by metric name and a tuple of
+        (label, value) pairs'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        # Each histogram is a count for each bucket, then +Inf, then the sum
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            key = (name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            counts = self.histograms[key]
+            counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            counts[-1] += value
+
+    def render(self):
+        # Everything, in the Prometheus text format
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        lines = []
+        described = set()
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP %s %s" % (name, METRIC_HELP.get(name, name)))
+                lines.append("# TYPE %s %s" % (name, kind))
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append("%s%s %s" % (name, metric_labels(labels), value))
+        for (name, labels), counts in histograms:
+            describe(name, 'histogram')
+            total = 0
+            for bound, count in zip(METRIC_BUCKETS + ('+Inf',), counts):
+                total += count
+                lines.append("%s_bucket%s %d" % (name, metric_labels(labels + (('le', str(bound)),)), total))
+            lines.append("%s_sum%s %f" % (name, metric_labels(labels), counts[-1]))
+            lines.append("%s_count%s %d" % (name, metric_labels(labels), total))
+        return "\n".join(lines) + "\n"
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % label for label in labels) + '}'
+
+def start_metrics(address):
+    # Serve the metrics on [HOST:]PORT, or a Unix socket if address is a path
+    global metrics
+    # Only loaded for --metrics, so startup doesn't pay for them
+    import http.server
+    import socketserver
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        ''' Serves GET /metrics'''
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            if verbose >= 2:
+                print("Metrics: %s" % (format % args))
+
+    class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            # Unix sockets have no client address, which the handler expects
+            request, _ = self.socket.accept()
+            return request, ('local', 0)
+
+    metrics = Metrics()
+    try:
+        if '/' in address:
+            if os.path.exists(address):
+                os.unlink(address)
+            server = UnixMetricsServer(address, MetricsHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+    except (OSError, ValueError) as e:
+        print("Could not serve metrics on %s: %s" % (address, e))
+        sys.exit(1)
+    # A real thread, even with --simulate - it doesn't run on the clock
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Profiling (--profile)
+#
+# Time is counted against a stack of names: where it was spent (a snowman,
+# or "main" for the all-snowmen displays), the pattern, and what it was
+# spent on - the pattern's own code ("draw"), setPixelColor/setPixels and
+# show() calls on its framebuffer, sleeping between frames, and its share
+# of the compositor sending frames to the LEDs ("driver"). CPU time is
+# counted separately, as it overlaps the others.
+
+# Where we are and the pattern being run - per thread, or per asyncio task
+profile_stack = contextvars.ContextVar('profile_stack', default=('main',))
+
+profiler = None
+
+class Profiler:
+    ''' Calls, pixels and seconds for each stack of names'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, what, secs, pixels=0, calls=1, stack=None):
+        if stack is None:
+            stack = profile_stack.get()
+        with self.lock:
+            counts = self.counts.setdefault(stack + (what,), [0, 0, 0.0])
+            counts[0] += calls
+            counts[1] += pixels
+            counts[2] += secs
+
+    def share(self, what, secs, stacks):
+        # Split secs evenly between stacks
+        for stack in stacks:
+            self.add(what, secs / len(stacks), stack=stack)
+
+    def write_collapsed(self, filename):
+        # Write the times, in microseconds, in the collapsed stack format
+        # read by flamegraph.pl and speedscope
+        with open(filename, 'w') as f:
+            for stack, (calls, pixels, secs) in sorted(self.counts.items()):
+                if stack[-1] != 'cpu' and secs >= 0.000001:
+                    f.write("%s %d\n" % (';'.join(stack), secs * 1000000))
+
+    def summary(self):
+        # Print the totals for each pattern, busiest first
+        patterns = {}
+        for stack, (calls, pixels, secs) in self.counts.items():
+            name = stack[-2] if len(stack) > 2 else stack[0]
+            totals = patterns.setdefault(name, {})
+            for what, value in (('calls', calls), ('pixels', pixels), (stack[-1], secs)):
+                if what in ('setPixelColor', 'setPixels'):
+                    totals['pixel'] = totals.get('pixel', 0.0) + value
+                    totals['calls'] = totals.get('calls', 0) + calls
+                    totals['pixels'] = totals.get('pixels', 0) + pixels
+                elif what == 'show':
+                    totals['show'] = totals.get('show', 0.0) + value
+                    totals['shows'] = totals.get('shows', 0) + calls
+                elif what not in ('calls', 'pixels'):
+                    totals[what] = totals.get(what, 0.0) + value
+        print("%-24s %8s %8s %6s %7s %7s %7s %7s %8s %7s" %
+              ("pattern", "calls", "pixels", "shows", "cpu", "draw", "pixel", "show", "sleep", "driver"))
+        for name in sorted(patterns, key=lambda name: -patterns[name].get('cpu', 0.0)):
+            totals = patterns[name]
+            print("%-24s %8d %8d %6d %7.3f %7.3f %7.3f %7.3f %8.2f %7.3f" %
+                  (name, totals.get('calls', 0), totals.get('pixels', 0), totals.get('shows', 0),
+                   totals.get('cpu', 0.0), totals.get('draw', 0.0), totals.get('pixel', 0.0),
+                   totals.get('show', 0.0), totals.get('sleep', 0.0), totals.get('driver', 0.0)))
+
+class ProfiledStrip:
+    ''' Wraps the strip (or framebuffer) a pattern draws on, for
+        --profile, timing its setPixelColor, setPixels and show calls'''
+    def __init__(self, strip):
+        self.strip = strip
+        # what -> [calls, pixels, seconds], passed to the profiler by flush()
+        self.counts = {}
+        self.secs = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.strip, name)
+
+    def setPixelColor(self, n, color):
+        start = time.perf_counter()
+        self.strip.setPixelColor(n, color)
+        self.spent('setPixelColor', start, 1)
+
+    def setPixels(self, n, colors):
+        start = time.perf_counter()
+        self.strip.setPixels(n, colors)
+        self.spent('setPixels', start, len(colors))
+
+    def show(self):
+        start = time.perf_counter()
+        changed = self.strip.show()
+        self.spent('show', start, 0)
+        return changed
+
+    def spent(self, what, start, pixels):
+        secs = time.perf_counter() - start
+        self.secs += secs
+        counts = self.counts.setdefault(what, [0, 0, 0.0])
+        counts[0] += 1
+        counts[1] += pixels
+        counts[2] += secs
+
+    def flush(self):
+        for what, (calls, pixels, secs) in self.counts.items():
+            profiler.add(what, secs, pixels, calls)
+        self.counts = {}
+
+def profiled(strip):
+    # With --profile, wrap a strip for patterns to draw on, so play()
+    # can time their calls to it
+    if profiler is None:
+        return strip
+    return ProfiledStrip(strip)
+
+def report_profile(filename):
+    # Write the flamegraph stacks, and print the summary
+    if profiler is None:
+        return
+    try:
+        profiler.write_collapsed(filename)
+    except OSError as e:
+        print("Could not write profile %s: %s" % (filename, e))
+    profiler.summary()
+
+# Output backends
+#
+# The compositor talks to the LEDs through a backend with the same
+# methods as rpi_ws281x.PixelStrip (begin, numPixels, setPixelColor,
+# getPixelColor, setBrightness, getBrightness, show). The "ws281x"
+# backend is the real PixelStrip; "null" and "record" need no hardware.
+
+BACKENDS = ('ws281x', 'null', 'record')
+
+class NullStrip:
+    ''' Backend which keeps the pixels in memory and discards each frame'''
+    def __init__(self, num, brightness=LED_BRIGHTNESS):
+        self.pixels = [BLACK] * num
+        self.brightness = brightness
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self.pixels)
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def getPixelColor(self, n):
+        return self.pixels[n]
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def getBrightness(self):
+        return self.brightness
+
+    def show(self):
+        self.shows += 1
+
+class RecordingStrip(NullStrip):
+    ''' Backend which keeps every frame shown, as (timestamp, pixels)
+        tuples in self.frames, for profiling and testing without LEDs.'''
+    def __init__(self, num, brightness=LED_BRIGHTNESS):
+        NullStrip.__init__(self, num, brightness)
+        self.frames = []
+
+    def show(self):
+        NullStrip.show(self)
+        self.frames.append((clock.monotonic(), array.array('I', self.pixels)))
+
+    def duration(self):
+        # Seconds between the first and last frames recorded
+        if len(self.frames) < 2:
+            return 0.0
+        return self.frames[-1][0] - self.frames[0][0]
+
+def report_recording(outputs):
+    # Say what any recording backends caught
+    for output in outputs:
+        if verbose >= 1 and isinstance(output.strip, RecordingStrip):
+            print("Output %s recorded %d frames over %.1f seconds" %
+                  (output.name, len(output.strip.frames), output.strip.duration()))
+
+# Set by --output-process to drive each strip from its own process
+output_process = False
+
+# Shared memory for an output process: a header of (frame sequence number,
+# brightness, stop flag), then two frame buffers. Frame n is written to
+# buffer n % 2 and only then published by setting the sequence number, so
+# the output process can read the latest frame while the next is written.
+SHARED_HEADER = struct.Struct('<III')
+
+class ProcessStrip(NullStrip):
+    ''' Backend which passes each frame to a separate process owning the
+        real strip (--output-process), so the LED refresh doesn't wait for
+        the GIL, and the patterns and the LEDs can use different cores.'''
+    def __init__(self, backend, num, brightness, pin, channel, dma):
+        # Only loaded for --output-process, so startup doesn't pay for them
+        import multiprocessing
+        from multiprocessing import shared_memory
+        NullStrip.__init__(self, num, brightness)
+        self.backend = backend
+        self.seq = 0
+        self.shm = shared_memory.SharedMemory(create=True, size=SHARED_HEADER.size + 2*num*4)
+        SHARED_HEADER.pack_into(self.shm.buf, 0, 0, brightness, 0)
+        self.buffers = [self.shm.buf[SHARED_HEADER.size + x*num*4:SHARED_HEADER.size + (x+1)*num*4].cast('I')
+                        for x in range(2)]
+        # Start the process without inheriting this one's threads
+        context = multiprocessing.get_context('spawn')
+        self.wake = context.Event()
+        self.ready = context.Event()
+        self.process = context.Process(target=run_output_process, name='output-%s' % backend,
+                                       args=(backend, num, brightness, pin, channel, dma,
+                                             self.shm.name, self.wake, self.ready, os.getpid()))
+        self.process.daemon = True
+
+    def begin(self):
+        # Wait for the output process to set up its strip
+        self.process.start()
+        while not self.ready.wait(0.1):
+            if not self.process.is_alive():
+                print("Output process for the %s backend failed" % self.backend)
+                self.close()
+                sys.exit(1)
+        atexit.register(self.close)
+
+    def show(self):
+        NullStrip.show(self)
+        seq = (self.seq + 1) & 0xffffffff
+        self.buffers[seq % 2][:] = array.array('I', self.pixels)
+        SHARED_HEADER.pack_into(self.shm.buf, 0, seq, self.brightness, 0)
+        self.seq = seq
+        self.wake.set()
+
+    def close(self):
+        # Stop the output process once it has shown the last frame
+        if self.shm is None:
+            return
+        if self.process.is_alive():
+            SHARED_HEADER.pack_into(self.shm.buf, 0, self.seq, self.brightness, 1)
+            self.wake.set()
+            self.process.join(2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        for buffer in self.buffers:
+            buffer.release()
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+def run_output_process(backend, num, brightness, pin, channel, dma, shmname, wake, ready, parent):
+    # Body of an --output-process process: create the real strip, then
+    # show the latest frame published in shared memory each time it is
+    # woken. Frames published while one is being shown are skipped.
+    from multiprocessing import shared_memory
+    # Ctrl-C is for the main process, which stops this one when it is done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    strip = make_strip(backend, num, brightness, pin, channel, dma)
+    shm = shared_memory.SharedMemory(name=shmname)
+    buffers = [shm.buf[SHARED_HEADER.size + x*num*4:SHARED_HEADER.size + (x+1)*num*4].cast('I')
+               for x in range(2)]
+    ready.set()
+    shown = 0
+    try:
+        while True:
+            if not wake.wait(1.0):
+                # Give up if the main process has gone
+                if os.getppid() != parent:
+                    break
+                continue
+            wake.clear()
+            seq, brightness, stop = SHARED_HEADER.unpack_from(shm.buf, 0)
+            if seq != shown:
+                # If another frame was published while copying this one,
+                # the buffer may have been overwritten - take the new one
+                while True:
+                    pixels = buffers[seq % 2].tolist()
+                    latest = SHARED_HEADER.unpack_from(shm.buf, 0)
+                    if latest[0] == seq:
+                        break
+                    seq, brightness, stop = latest
+                if brightness != strip.getBrightness():
+                    strip.setBrightness(brightness)
+                for n, color in enumerate(pixels):
+                    strip.setPixelColor(n, color)
                 strip.show()
+                shown = seq
+            if stop:
+                break
+    finally:
+        for buffer in buffers:
+            buffer.release()
+        shm.close()
+
+def make_strip(backend, num, brightness, pin=LED_PIN, channel=LED_CHANNEL, dma=LED_DMA):
+    # Create (and begin) the output strip for the named backend
+    if output_process:
+        strip = ProcessStrip(backend, num, brightness, pin, channel, dma)
+    elif backend == 'ws281x':
+        rpi_ws281x = lazy_import('rpi_ws281x')
+        if rpi_ws281x is None:
+            print("Could not load rpi_ws281x module - try '--backend null'")
+            sys.exit(1)
+        strip = rpi_ws281x.PixelStrip(num, pin, LED_FREQ_HZ, dma, LED_INVERT, brightness, channel)
+    elif backend == 'null':
+        strip = NullStrip(num, brightness)
+    elif backend == 'record':
+        strip = RecordingStrip(num, brightness)
+    else:
+        print("Unknown backend %s" % backend)
+        sys.exit(1)
+    # Intialize the library (must be called once before other functions).
+    strip.begin()
+    return strip
+
+class Output:
+    ''' One LED strip, and the snowmen wired to it in chain order
+        (the first snowman listed is the one nearest the Pi).'''
+    def __init__(self, name, strip, snowmen):
+        self.name = name
+        self.strip = strip
+        self.snowmen = list(snowmen)
+        # Set when one of the snowmen has committed a frame since the last push
+        self.dirty = False
+        # Shadow copy of the pixels last sent to the strip
+        self.sent = None
+        self.shows = 0
+        self.suppressed = 0
+
+    def write(self, pixels):
+        # Copy this output's snowmen out of the chain's pixels, and show them
+        # if they differ from what the strip already has.
+        # Return True if they were sent.
+        mine = []
+        for snowman in self.snowmen:
+            mine.extend(pixels[snowman*LED_COUNT:(snowman+1)*LED_COUNT])
+        if mine == self.sent:
+            self.suppressed += 1
+            return False
+        for n, color in enumerate(mine):
+            self.strip.setPixelColor(n, color)
+        if metrics is not None:
+            start = time.perf_counter()
+            self.strip.show()
+            metrics.observe('snowrgb_show_seconds', time.perf_counter() - start, (('output', self.name),))
         else:
-            print("Invalid type for head_led %s" % repr(type(head_led)))
+            self.strip.show()
+        self.sent = mine
+        self.shows += 1
+        return True
+
+def parse_snowmen(text):
+    # Turn a list of snowman numbers and ranges, e.g. "0-9,12", into a list
+    snowmen = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        snowmen.extend(range(int(first), int(last or first) + 1))
+    return snowmen
+
+# GPIO pins which rpi_ws281x drives with the PWM peripheral. Both PWM
+# channels share one FIFO, fed by a single ws2811_t, so only one ws281x
+# output can use them. Others can be SPI (GPIO10) or PCM (GPIO21).
+PWM_PINS = (12, 13, 18, 19, 40, 41, 45, 52, 53)
+SPI_PIN = 10
+
+def read_outputs(filename, nummen, brightness):
+    ''' Read an output mapping file, and create the strip for each output.
+        Each line is "name=backend[:pin[:channel[:dma]]] snowmen", e.g.
+            left=ws281x:18:0:10 0-19
+            right=ws281x:21:0:11 20-39
+        (PWM on GPIO18 and PCM on GPIO21). Every snowman from 0 to
+        nummen-1 must be on exactly one output, and only one ws281x
+        output may be on a PWM pin.'''
+    try:
+        with open(filename, 'r') as f:
+            lines = [x.split('#')[0].strip() for x in f.readlines()]
+    except OSError as e:
+        print("Could not read output mapping %s: %s" % (filename, e))
+        sys.exit(1)
+    outputs = []
+    used = {}
+    # ws281x pins and DMA channels in use -> output name
+    pins = {}
+    dmas = {}
+    for line in lines:
+        if not line:
+            continue
+        try:
+            name, spec = line.split('=', 1)
+            spec, snowmen = spec.split()
+            spec = spec.split(':')
+            backend = spec[0]
+            pin, channel, dma = [int(x) for x in spec[1:]] + [LED_PIN, LED_CHANNEL, LED_DMA][len(spec)-1:]
+            snowmen = parse_snowmen(snowmen)
+        except ValueError:
+            print("Invalid output mapping line in %s: %s" % (filename, line))
+            sys.exit(1)
+        for snowman in snowmen:
+            if snowman in used or not 0 <= snowman < nummen:
+                print("Snowman %d can't be on output %s" % (snowman, name))
+                sys.exit(1)
+            used[snowman] = name
+        if backend == 'ws281x':
+            pwm = [x for x in pins if x in PWM_PINS]
+            if pin in pins:
+                print("Outputs %s and %s are both on GPIO%d" % (pins[pin], name, pin))
+                sys.exit(1)
+            if pin in PWM_PINS and pwm:
+                print("Outputs %s and %s both use PWM, which only one output can - "
+                      "use SPI (GPIO10) or PCM (GPIO21) for the other" % (pins[pwm[0]], name))
+                sys.exit(1)
+            # SPI doesn't use a DMA channel
+            if pin != SPI_PIN:
+                if dma in dmas:
+                    print("Outputs %s and %s both use DMA channel %d" % (dmas[dma], name, dma))
+                    sys.exit(1)
+                dmas[dma] = name
+            pins[pin] = name
+        # Never drive the real LEDs from a simulation
+        if args.simulate and backend == 'ws281x':
+            backend = 'null'
+        outputs.append(Output(name.strip(), make_strip(backend, len(snowmen)*LED_COUNT, brightness, pin, channel, dma), snowmen))
+    missing = [snowman for snowman in range(nummen) if snowman not in used]
+    if missing:
+        print("Snowmen %s are not on any output in %s" % (repr(missing), filename))
+        sys.exit(1)
+    return outputs
+
+class SnowmanFrame:
+    ''' Framebuffer for the LEDs of a single snowman.
+        Patterns write pixels here with setPixelColor(), using the same
+        chain-wide LED numbers as they would on the real strip, and
+        show() hands the finished frame to the compositor.'''
+    def __init__(self, compositor, snowman):
+        self.compositor = compositor
+        self.snowman = snowman
+        self.baseLED = snowman * LED_COUNT
+        self.pixels = [BLACK] * LED_COUNT
+
+    def numPixels(self):
+        return LED_COUNT
+
+    def setPixelColor(self, n, color):
+        self.pixels[n - self.baseLED] = color
+
+    def getPixelColor(self, n):
+        return self.pixels[n - self.baseLED]
+
+    def setPixels(self, n, colors):
+        # Set a run of pixels starting at LED n, in one slice copy
+        start = n - self.baseLED
+        self.pixels[start:start+len(colors)] = colors
+
+    def show(self):
+        # Return False if the frame was the same as the one already committed
+        return self.compositor.commit(self)
+
+class Compositor:
+    ''' Owns the output strips for the whole chain.
+        Each snowman writes into its own SnowmanFrame; the compositor
+        thread copies committed frames into the strips and calls show()
+        at most FRAME_HZ times a second, however many snowmen there are.
+        Only the outputs whose snowmen have changed are sent.
+        The compositor can also be used as a strip for the whole chain
+        (as the all_snowmen_* patterns do).'''
+    def __init__(self, outputs, nummen):
+        self.outputs = outputs
+        # The output each snowman is on
+        self.output_of = {}
+        for output in outputs:
+            for snowman in output.snowmen:
+                self.output_of[snowman] = output
+        self.frames = [SnowmanFrame(self, snowman) for snowman in range(nummen)]
+        # Committed pixels for the whole chain, protected by lock
+        self.pixels = [BLACK] * (nummen * LED_COUNT)
+        # Snowmen not committed yet. Their LEDs may still be lit from an
+        # earlier run, so their first frame is always sent, even if black
+        self.unknown = set(range(nummen))
+        self.lock = threading.Lock()
+        # Held while pushing, so flush() can push from any thread
+        self.push_lock = threading.Lock()
+        self.dirty = clock.Event()
+        self.running = False
+        self.thread = None
+        self.shows = 0
+        self.pixels_sent = 0
+        # Commits which didn't change anything
+        self.suppressed = 0
+        # FrameRecorder for --record, given each frame sent
+        self.recorder = None
+        # With --profile, the profile_stack of everything committed since
+        # the last push, to share the time spent sending it
+        self.committers = {}
+        # Functions to run in the compositor thread, before the next push
+        # (see --control)
+        self.commands = queue.Queue()
+
+    def frame(self, snowman):
+        return self.frames[snowman]
+
+    def numPixels(self):
+        return len(self.pixels)
+
+    def setPixelColor(self, n, color):
+        self.frames[n // LED_COUNT].setPixelColor(n, color)
+
+    def getPixelColor(self, n):
+        return self.frames[n // LED_COUNT].getPixelColor(n)
+
+    def setPixels(self, n, colors):
+        # Set a run of pixels starting at LED n, which may cross snowmen
+        done = 0
+        while done < len(colors):
+            frame = self.frames[(n + done) // LED_COUNT]
+            count = min(len(colors) - done, frame.baseLED + LED_COUNT - (n + done))
+            frame.setPixels(n + done, colors[done:done+count])
+            done += count
+
+    def setBrightness(self, brightness):
+        # Set the brightness of every output, and send the frames again
+        with self.lock:
+            for output in self.outputs:
+                output.strip.setBrightness(brightness)
+                output.sent = None
+                output.dirty = True
+            self.dirty.set()
+
+    def command(self, function):
+        # Have the compositor thread run function before its next push.
+        # May be called from any thread
+        self.commands.put(function)
+        self.dirty.set()
+
+    def run_commands(self):
+        while True:
+            try:
+                function = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            # A bad command mustn't stop the only thread that calls show()
+            try:
+                function()
+            except Exception as e:
+                print("%s Control command failed: %s" % (datenow(), e))
+
+    def show(self):
+        # Commit every snowman's frame at once.
+        # Return False if none of them had changed
+        with self.lock:
+            changed = False
+            for frame in self.frames:
+                changed = self.commit_locked(frame) or changed
+            if not changed:
+                self.suppressed += 1
+            return changed
+
+    def commit(self, frame):
+        # Copy one snowman's frame into the chain, to go out on the next tick.
+        # Return False (and send nothing) if it is the same as the last one
+        with self.lock:
+            changed = self.commit_locked(frame)
+            if not changed:
+                self.suppressed += 1
+            return changed
+
+    def commit_locked(self, frame):
+        # commit(), with the lock already held.
+        # self.pixels is the shadow copy of the last committed frames
+        if (frame.snowman not in self.unknown and
+                self.pixels[frame.baseLED:frame.baseLED+LED_COUNT] == frame.pixels):
+            if metrics is not None:
+                metrics.inc('snowrgb_frames_suppressed_total', (('snowman', str(frame.snowman)),))
+            return False
+        if metrics is not None:
+            metrics.inc('snowrgb_frames_committed_total', (('snowman', str(frame.snowman)),))
+        if profiler is not None:
+            self.committers[profile_stack.get()] = True
+        self.pixels[frame.baseLED:frame.baseLED+LED_COUNT] = frame.pixels
+        self.unknown.discard(frame.snowman)
+        self.output_of[frame.snowman].dirty = True
+        self.dirty.set()
+        return True
+
+    def push(self):
+        # Send the committed pixels to each output that has changed.
+        # A ws281x show() on PWM or PCM only waits for that output's
+        # previous DMA transfer, so a PWM output and a PCM output go out in
+        # parallel, and the frame takes as long as the longer of the two
+        # rather than the whole chain.
+        with self.push_lock:
+            with self.lock:
+                self.dirty.clear()
+                pixels = list(self.pixels)
+                outputs = [output for output in self.outputs if output.dirty]
+                for output in outputs:
+                    output.dirty = False
+                committers = list(self.committers)
+                self.committers.clear()
+            start = time.perf_counter()
+            sent = False
+            for output in outputs:
+                if output.write(pixels):
+                    self.pixels_sent += len(output.snowmen) * LED_COUNT
+                    sent = True
+            if profiler is not None and committers:
+                profiler.share('driver', time.perf_counter() - start, committers)
+            if sent:
+                self.shows += 1
+                if self.recorder is not None:
+                    self.recorder.add(clock.monotonic(), pixels)
+
+    def flush(self):
+        # Push any committed frame now, rather than waiting for the thread
+        if self.dirty.is_set():
+            self.push()
+
+    def run(self):
+        # Compositor thread - wait for a commit, push it, then wait out the tick
+        tick = 1.0 / FRAME_HZ
+        while self.running:
+            if not self.dirty.wait(0.5):
+                continue
+            start = clock.monotonic()
+            self.run_commands()
+            self.push()
+            remaining = tick - (clock.monotonic() - start)
+            if remaining > 0:
+                clock.sleep(remaining)
+
+    async def run_async(self):
+        # Compositor task for --asyncio
+        tick = 1.0 / FRAME_HZ
+        self.running = True
+        while self.running:
+            await self.dirty.wait()
+            start = clock.monotonic()
+            self.run_commands()
+            self.push()
+            remaining = tick - (clock.monotonic() - start)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+
+    def start(self):
+        self.running = True
+        self.thread = clock.Thread(target=self.run, name="compositor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # Stop the compositor thread, and make sure the last frame gets out
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+class Trail:
+    ''' Fixed-size ring buffer of lit LEDs, oldest first, for patterns
+        which leave a trail of lights that goes out behind them.
+        Each entry is a tuple of the chain-wide LED numbers lit together.'''
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, leds):
+        if self.count == len(self.slots):
+            raise IndexError("Trail is full")
+        self.slots[(self.head + self.count) % len(self.slots)] = leds
+        self.count += 1
+
+    def pop(self):
+        leds = self.slots[self.head]
+        self.slots[self.head] = None
+        self.head = (self.head + 1) % len(self.slots)
+        self.count -= 1
+        return leds
+
+    def release(self, strip, keep):
+        # Turn off the oldest entries until only keep are left.
+        # They go out with the next frame shown.
+        while self.count > keep:
+            for led in self.pop():
+                strip.setPixelColor(led, BLACK)
+
+    def drain(self, strip, wait_ms):
+        # Pattern steps turning off the rest of the trail, oldest first
+        while self.count:
+            self.release(strip, self.count - 1)
+            yield wait_ms
+
+# Frame recordings (--record and --replay)
+#
+# A recording file is a header (RECORD_HEADER: magic and pixels per frame)
+# followed by fixed-size frames, each one the seconds since the recording
+# started (a little-endian double) and then the pixels for the whole chain
+# as little-endian uint32s. Frames are buffered and appended a chunk at a
+# time, and the fixed size lets --replay find any frame in the mmapped file.
+
+RECORD_MAGIC = b'SNOWRGB1'
+RECORD_HEADER = struct.Struct('<8sI')
+RECORD_STAMP = struct.Struct('<d')
+RECORD_CHUNK = 256    # Frames buffered before each write
+
+class FrameRecorder:
+    ''' Appends every frame the compositor sends to a recording file'''
+    def __init__(self, filename, numpixels):
+        self.numpixels = numpixels
+        self.file = open(filename, 'wb')
+        self.file.write(RECORD_HEADER.pack(RECORD_MAGIC, numpixels))
+        self.chunk = bytearray()
+        self.count = 0
+        self.start = None
+
+    def add(self, timestamp, pixels):
+        if self.start is None:
+            self.start = timestamp
+        frame = array.array('I', pixels)
+        if sys.byteorder == 'big':
+            frame.byteswap()
+        self.chunk += RECORD_STAMP.pack(timestamp - self.start)
+        self.chunk += frame.tobytes()
+        self.count += 1
+        if self.count % RECORD_CHUNK == 0:
+            self.write()
+
+    def write(self):
+        self.file.write(self.chunk)
+        self.chunk = bytearray()
+
+    def close(self):
+        self.write()
+        self.file.close()
+        if verbose >= 1:
+            print("Recorded %d frames to %s" % (self.count, self.file.name))
+
+class Recording:
+    ''' A recording file, memory-mapped for replaying'''
+    def __init__(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.numpixels = RECORD_HEADER.unpack_from(self.map)
+        except (OSError, ValueError, struct.error) as e:
+            print("Could not read recording %s: %s" % (filename, e))
+            sys.exit(1)
+        if magic != RECORD_MAGIC or self.numpixels % LED_COUNT:
+            print("%s is not a recording" % filename)
             sys.exit(1)
-        time.sleep(wait_ms/1000.0)
-    # Above doesn't updated caller's hold_leds, so return updated list
-    return hold_leds
+        self.nummen = self.numpixels // LED_COUNT
+        self.framesize = RECORD_STAMP.size + self.numpixels * 4
+        # Ignore any partly written frame at the end
+        self.count = (len(self.map) - RECORD_HEADER.size) // self.framesize
+
+    def __len__(self):
+        return self.count
+
+    def frame(self, n):
+        # Return (seconds from the start, pixels) for frame n.
+        # The pixels are a view of the file, not a copy
+        offset = RECORD_HEADER.size + n * self.framesize
+        timestamp, = RECORD_STAMP.unpack_from(self.map, offset)
+        offset += RECORD_STAMP.size
+        pixels = memoryview(self.map)[offset:offset + self.numpixels*4]
+        if sys.byteorder == 'big':
+            pixels = array.array('I', pixels)
+            pixels.byteswap()
+        else:
+            pixels = pixels.cast('I')
+        return timestamp, pixels
+
+    def duration(self):
+        if self.count == 0:
+            return 0.0
+        return self.frame(self.count - 1)[0]
+
+def replay(recording, outputs):
+    ''' Send every frame of a recording to the outputs, at the times
+        they were recorded. No pattern code runs at all.'''
+    start = clock.monotonic()
+    for n in range(len(recording)):
+        timestamp, pixels = recording.frame(n)
+        delay = start + timestamp - clock.monotonic()
+        if delay > 0:
+            clock.sleep(delay)
+        for output in outputs:
+            output.write(pixels)
+        if stopping.is_set():
+            break
+
+# Pattern engine
+#
+# Each pattern is a generator. It writes the pixels for one step into
+# strip with setPixelColor(), then yields the number of milliseconds to
+# hold them for. play() does the show() and sleep for each step, so all
+# the writes in a step go out in a single frame, and steps which yield 0
+# are merged into the next step. Any writes after the last yield are left
+# in the framebuffer for the next pattern to show.
+
+# Frame counts and timings for each pattern since startup, keyed by pattern name
+pattern_stats = {}
+pattern_lock = threading.Lock()
+
+class FrameStats:
+    ''' Frame counts and timing for a pattern.
+        Nominal is the total time the frames asked to be held for, and
+        jitter is how late each frame's deadline was met, in seconds.'''
+    def __init__(self):
+        self.nominal = 0.0
+        self.shows = 0
+        self.suppressed = 0
+        self.skipped = 0
+        self.frames = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.runs = 0
+        self.runtime = 0.0
+
+    def add(self, other):
+        self.nominal += other.nominal
+        self.shows += other.shows
+        self.suppressed += other.suppressed
+        self.skipped += other.skipped
+        self.frames += other.frames
+        self.jitter_total += other.jitter_total
+        self.jitter_max = max(self.jitter_max, other.jitter_max)
+        self.runs += other.runs
+        self.runtime += other.runtime
+
+    def jitter_mean(self):
+        if self.frames == 0:
+            return 0.0
+        return self.jitter_total / self.frames
+
+class FrameTimer:
+    ''' Paces frames against absolute deadlines on the clock, so time
+        spent drawing and in show() comes out of each wait instead of
+        adding to it, and a pattern which falls behind catches up rather
+        than drifting. Timings are collected in self.stats.
+        The first frame is due at start (a clock.monotonic() time), or now.'''
+    def __init__(self, start=None):
+        self.deadline = clock.monotonic() if start is None else start
+        self.start = self.deadline
+        self.stats = FrameStats()
+        # The ProfiledStrip, with --profile
+        self.strip = None
+
+    def profile(self, strip, name):
+        # With --profile, count what follows as pattern name's, and return
+        # a wrapper for strip to time its calls. Otherwise just return strip
+        if profiler is None:
+            return strip
+        self.token = profile_stack.set(profile_stack.get() + (name,))
+        if isinstance(strip, ProfiledStrip):
+            # The pattern was given a profiled() strip to draw on
+            self.strip = strip
+            strip.secs = 0.0
+        else:
+            self.strip = ProfiledStrip(strip)
+        self.busy = 0.0
+        self.cpu = 0.0
+        self.busy_from = time.perf_counter()
+        self.cpu_from = time.thread_time()
+        return self.strip
+
+    def pause(self):
+        # Stop counting busy and CPU time (the pattern is about to sleep)
+        self.sleep_from = time.perf_counter()
+        self.busy += self.sleep_from - self.busy_from
+        self.cpu += time.thread_time() - self.cpu_from
+
+    def late(self, wait_ms):
+        # True if a frame held for wait_ms would already be over,
+        # so there's no point showing it
+        return clock.monotonic() >= self.deadline + wait_ms / 1000.0
+
+    def shown(self, changed=None):
+        # changed is what show() returned - False if the frame was
+        # suppressed because nothing had changed (a real PixelStrip
+        # returns None, so its frames always count as shows)
+        if changed is False:
+            self.stats.suppressed += 1
+        else:
+            self.stats.shows += 1
+
+    def skip(self):
+        self.stats.skipped += 1
+
+    def next_deadline(self, wait_ms):
+        # Move on to the end of the current frame.
+        # Return the seconds left until then (0 if already late)
+        self.deadline += wait_ms / 1000.0
+        self.stats.nominal += wait_ms / 1000.0
+        if self.strip is not None:
+            self.pause()
+        return max(self.deadline - clock.monotonic(), 0.0)
+
+    def woke(self):
+        # Called after sleeping until the deadline
+        jitter = clock.monotonic() - self.deadline
+        self.stats.frames += 1
+        self.stats.jitter_total += jitter
+        self.stats.jitter_max = max(self.stats.jitter_max, jitter)
+        if metrics is not None:
+            metrics.observe('snowrgb_sleep_overshoot_seconds', jitter)
+        if self.strip is not None:
+            self.busy_from = time.perf_counter()
+            self.cpu_from = time.thread_time()
+            profiler.add('sleep', self.busy_from - self.sleep_from)
+
+    def finish(self):
+        # Called when the pattern is over - return its FrameStats
+        self.stats.runs = 1
+        self.stats.runtime = clock.monotonic() - self.start
+        if self.strip is not None:
+            self.pause()
+            self.strip.flush()
+            profiler.add('draw', self.busy - self.strip.secs, calls=0)
+            profiler.add('cpu', self.cpu, calls=0)
+            profile_stack.reset(self.token)
+            self.strip = None
+        return self.stats
+
+def play_frames(strip, steps, timer):
+    # Show the frames of a pattern generator on strip, yielding the
+    # seconds to sleep after each one, for play() or play_async()
+    pending = False
+    for wait_ms in steps:
+        pending = True
+        if wait_ms:
+            if timer.late(wait_ms):
+                # Leave the writes pending, for the next frame to show
+                timer.skip()
+            else:
+                timer.shown(strip.show())
+                pending = False
+            yield timer.next_deadline(wait_ms)
+            timer.woke()
+    if pending:
+        timer.shown(strip.show())
+
+def play(strip, steps, timer=None):
+    ''' Run a pattern generator on strip, paced by timer (a new FrameTimer
+        by default).
+        Return the number of frames shown.'''
+    timer = timer or FrameTimer()
+    strip = timer.profile(strip, steps.__name__)
+    for secs in play_frames(strip, steps, timer):
+        if secs > 0:
+            clock.sleep(secs)
+    count_frames(steps.__name__, timer.finish())
+    return timer.stats.shows
+
+async def play_async(strip, steps, timer=None):
+    # play() for asyncio tasks
+    timer = timer or FrameTimer()
+    strip = timer.profile(strip, steps.__name__)
+    for secs in play_frames(strip, steps, timer):
+        await asyncio.sleep(secs)
+    count_frames(steps.__name__, timer.finish())
+    return timer.stats.shows
+
+def count_frames(name, stats):
+    # Add a run's FrameStats to the totals for pattern name
+    with pattern_lock:
+        if name not in pattern_stats:
+            pattern_stats[name] = FrameStats()
+        pattern_stats[name].add(stats)
+    if metrics is not None:
+        metrics.observe('snowrgb_pattern_seconds', stats.runtime, (('pattern', name),))
+        if stats.skipped:
+            metrics.inc('snowrgb_frames_skipped_total', (('pattern', name),), stats.skipped)
 
 def headTieOn(strip, baseLED, wait_ms=100):   #Eyes, node and tie on
     for x in NOSE:
         strip.setPixelColor(baseLED+x, ORANGE)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
     for x in EYES:
         strip.setPixelColor(baseLED+x, BLUE)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
     for x in TIE:
         strip.setPixelColor(baseLED+x, cheercolour)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
-    return
+        yield wait_ms
 
 def spin(strip, baseLED):   #Clockwise
     for i in ARMS:
         strip.setPixelColor(baseLED+i, BLACK)
-        strip.show()
     for n in range(10):
         for i in ARMS:
             strip.setPixelColor(baseLED+i, WHITE)
-            strip.show()
-            time.sleep(0.07)
+            yield 70
             strip.setPixelColor(baseLED+i, BLACK)
-            strip.show()
     for i in ARMS:
         strip.setPixelColor(baseLED+i, WHITE)
-        strip.show()
-    time.sleep(0.3)
-    return
+    yield 300
 
 def spin2(strip, baseLED):   # Counter Clockwise
     for i in ARMS:
         strip.setPixelColor(baseLED+i, BLACK)
-        strip.show()
     for n in range(10):
         for i in ARMS2:
             strip.setPixelColor(baseLED+i, WHITE)
-            strip.show()
-            time.sleep(0.07)
+            yield 70
             strip.setPixelColor(baseLED+i, BLACK)
-            strip.show()
     for i in ARMS2:
         strip.setPixelColor(baseLED+i, WHITE)
-        strip.show()
-    time.sleep(0.3)
-    return
+    yield 300
 
 def wink(strip, baseLED):
     for  n in range(4):
         strip.setPixelColor(baseLED+10, BLACK)
-        strip.show()
-        time.sleep(0.2)
+        yield 200
         strip.setPixelColor(baseLED+10, BLUE)
-        strip.show()
-        time.sleep(1.0)
-    return
+        yield 1000
 
 def wink2(strip, baseLED):
     for  n in range(4):
         strip.setPixelColor(baseLED+11, BLACK)
-        strip.show()
-        time.sleep(0.2)
+        yield 200
         strip.setPixelColor(baseLED+11, BLUE)
-        strip.show()
-        time.sleep(1.0)
-    return
+        yield 1000
 
 def upDown(strip, baseLED):                  # Up and Down
     for n in range(1):
         for x in ((0, 3, 6), (1, 4, 7), (2, 5, 8), (9,), (11, 10)):
             for i in x:
                 strip.setPixelColor(baseLED+i, BLACK)
-                strip.show()
-            time.sleep(0.2)
+            yield 200
             for i in x:
                 strip.setPixelColor(baseLED+i, LEDCOLORS[i])
-                strip.show()
-            time.sleep(0.2)
+            yield 200
         for x in ((11, 10), (9,), (2, 5, 8), (1, 4, 7), (0, 3, 6)):
             for i in x:
                 strip.setPixelColor(baseLED+i, BLACK)
-                strip.show()
-            time.sleep(0.2)
+            yield 200
             for i in x:
                 strip.setPixelColor(baseLED+i, LEDCOLORS[i])
-                strip.show()
-            time.sleep(0.2)
-        time.sleep(0.5)
-    return
+            yield 200
+        yield 500
 
 def wobble(strip, baseLED):                  # Side to side
     for n in range(6):
         for i in ARML:
             strip.setPixelColor(baseLED+i, BLACK)
-        strip.show()
-        time.sleep(0.1)
+        yield 100
         for i in ARML:
             strip.setPixelColor(baseLED+i, WHITE)
-        strip.show()
-        time.sleep(0.1)
-        time.sleep(0.2)
+        yield 300
         for i in ARMR:
             strip.setPixelColor(baseLED+i, BLACK)
-        strip.show()
-        time.sleep(0.1)
+        yield 100
         for i in ARMR:
             strip.setPixelColor(baseLED+i, WHITE)
-        strip.show()
-        time.sleep(0.1)
-        time.sleep(0.2)
-    return
+        yield 300
 
 def allOn(strip, baseLED, wait_ms=100):
     for x in ARMS:
         strip.setPixelColor(baseLED+x, WHITE)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
     for x in TIE:
         strip.setPixelColor(baseLED+x, cheercolour)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
     for x in NOSE:
         strip.setPixelColor(baseLED+x, ORANGE)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
     for x in EYES:
         strip.setPixelColor(baseLED+x, BLUE)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
 
 def allOff(strip, baseLED, wait_ms=100):
     for x in range(LED_COUNT):
         strip.setPixelColor(baseLED+x, BLACK)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
 
 def colorWipe(strip, baseLED, color, wait_ms=40):
     """Wipe color across display a pixel at a time."""
     for i in range(0, LED_COUNT):
         strip.setPixelColor(baseLED+i, color)
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        yield wait_ms
 
 
 def theaterChase(strip, baseLED, color, wait_ms=50, iterations=8):
@@ -288,8 +1601,7 @@ def theaterChase(strip, baseLED, color, wait_ms=50, iterations=8):
         for q in range(3):
             for i in range(0, LED_COUNT, 3):
                 strip.setPixelColor(baseLED+i + q, color)
-            strip.show()
-            time.sleep(wait_ms / 1000.0)
+            yield wait_ms
             for i in range(0, LED_COUNT, 3):
                 strip.setPixelColor(baseLED+i + q, 0)
 
@@ -305,24 +1617,50 @@ def wheel(pos):
         pos -= 170
         return Color(0, pos * 3, 255 - pos * 3)
 
+# Colour wheel lookup table, WHEEL[pos] == wheel(pos)
+WHEEL = [wheel(pos) for pos in range(256)]
+
+def rainbow_table(offsets):
+    """Return 256 rainbow frames, one per step j, where pixel i of
+    frame j is WHEEL[(offsets[i] + j) & 255]."""
+    # NumPy is optional - without it the tables are built in Python
+    numpy = lazy_import('numpy')
+    if numpy is not None:
+        lut = numpy.array(WHEEL, dtype=numpy.uint32)
+        index = (numpy.arange(256)[:, None] + numpy.array(offsets)[None, :]) & 255
+        return lut[index].tolist()
+    return [[WHEEL[(offset + j) & 255] for offset in offsets] for j in range(256)]
+
+# Every frame of the rainbow patterns, so drawing a frame is one slice copy.
+# Each table is built the first time its pattern runs, so if the rainbow
+# patterns aren't used, neither the tables nor NumPy are loaded.
+RAINBOW_OFFSETS = {
+    'rainbow': range(LED_COUNT),
+    'rainbowCycle': [int(i * 256 / LED_COUNT) for i in range(LED_COUNT)],
+}
+rainbow_tables = {}
+
+def rainbow_frames(name):
+    frames = rainbow_tables.get(name)
+    if frames is None:
+        frames = rainbow_tables[name] = rainbow_table(RAINBOW_OFFSETS[name])
+    return frames
+
 
 def rainbow(strip, baseLED, wait_ms=20, iterations=1):
     """Draw rainbow that fades across all pixels at once."""
+    frames = rainbow_frames('rainbow')
     for j in range(256 * iterations):
-        for i in range(LED_COUNT):
-            strip.setPixelColor(baseLED+i, wheel((i + j) & 255))
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        strip.setPixels(baseLED, frames[j & 255])
+        yield wait_ms
 
 
 def rainbowCycle(strip, baseLED, wait_ms=3, iterations=5):
     """Draw rainbow that uniformly distributes itself across all pixels."""
+    frames = rainbow_frames('rainbowCycle')
     for j in range(256 * iterations):
-        for i in range(LED_COUNT):
-            strip.setPixelColor(baseLED+i, wheel(
-                (int(i * 256 / LED_COUNT) + j) & 255))
-        strip.show()
-        time.sleep(wait_ms / 1000.0)
+        strip.setPixels(baseLED, frames[j & 255])
+        yield wait_ms
 
 
 def theaterChaseRainbow(strip, baseLED, wait_ms=50):
@@ -330,60 +1668,362 @@ def theaterChaseRainbow(strip, baseLED, wait_ms=50):
     for j in range(256):
         for q in range(3):
             for i in range(0, LED_COUNT, 3):
-                strip.setPixelColor(baseLED+i + q, wheel((i + j) % 255))
-            strip.show()
-            time.sleep(wait_ms / 1000.0)
+                strip.setPixelColor(baseLED+i + q, WHEEL[(i + j) % 255])
+            yield wait_ms
             for i in range(0, LED_COUNT, 3):
                 strip.setPixelColor(baseLED+i + q, 0)
 
 def runTheaterChase(strip, baseLED):
-    theaterChase(strip, baseLED, Color(127, 127, 127))  # White theater chase
-    theaterChase(strip, baseLED, Color(127, 0, 0))  # Red theater chase
-    theaterChase(strip, baseLED, Color(0, 0, 127))  # Blue theater chase
-    theaterChase(strip, baseLED, cheercolour)       # Cheerlights theater chase
+    yield from theaterChase(strip, baseLED, Color(127, 127, 127))  # White theater chase
+    yield from theaterChase(strip, baseLED, Color(127, 0, 0))  # Red theater chase
+    yield from theaterChase(strip, baseLED, Color(0, 0, 127))  # Blue theater chase
+    yield from theaterChase(strip, baseLED, cheercolour)       # Cheerlights theater chase
 
 def runColorWipe(strip, baseLED):
     for n in range(3):
-        colorWipe(strip, baseLED, Color(255, 0, 0))  # Red wipe
-        colorWipe(strip, baseLED, Color(0, 255, 0))  # Blue wipe
-        colorWipe(strip, baseLED, Color(0, 0, 255))  # Green wipe
-        colorWipe(strip, baseLED, cheercolour)       # Cheerlights wipe
+        yield from colorWipe(strip, baseLED, Color(255, 0, 0))  # Red wipe
+        yield from colorWipe(strip, baseLED, Color(0, 255, 0))  # Blue wipe
+        yield from colorWipe(strip, baseLED, Color(0, 0, 255))  # Green wipe
+        yield from colorWipe(strip, baseLED, cheercolour)       # Cheerlights wipe
 
 def runRainbows(strip, baseLED):
-    rainbow(strip, baseLED)
-    rainbowCycle(strip, baseLED)
-
-def all_snowmen_arms(strip, wait_ms=30):
+    yield from rainbow(strip, baseLED)
+    yield from rainbowCycle(strip, baseLED)
+
+# Pattern registry
+#
+# Everything a snowman can pick to show, with its family (as the -a, -t, -w
+# and -r options - None for patterns which are only shown when asked for),
+# how likely it is to be picked compared with the others, roughly how long
+# it lasts and how many frames it sends to the LEDs. pick_pattern() chooses
+# by weight from the enabled families only, so no turn is wasted.
+
+class PatternInfo:
+    ''' A registered pattern: the (pattern, kwargs) steps it plays'''
+    def __init__(self, name, family, steps, weight=1.0, duration=5.0, cost=100):
+        self.name = name
+        self.family = family
+        self.steps = steps
+        self.weight = weight
+        self.duration = duration    # Seconds
+        self.cost = cost            # Frames shown
+
+PATTERN_REGISTRY = (
+    PatternInfo('spin', 'a', ((headTieOn, {'wait_ms': 0}), (spin, {})), duration=4.5, cost=62),
+    PatternInfo('spin2', 'a', ((headTieOn, {'wait_ms': 0}), (spin2, {})), duration=4.5, cost=62),
+    PatternInfo('wink', 'a', ((allOn, {'wait_ms': 0}), (wink, {})), duration=4.8, cost=9),
+    PatternInfo('wink2', 'a', ((allOn, {'wait_ms': 0}), (wink2, {})), duration=4.8, cost=9),
+    PatternInfo('wobble', 'a', ((headTieOn, {'wait_ms': 0}), (wobble, {})), duration=4.8, cost=25),
+    PatternInfo('upDown', 'a', ((upDown, {}),), duration=4.5, cost=21),
+    PatternInfo('theaterChase', 't', ((runTheaterChase, {}),), duration=4.8, cost=96),
+    PatternInfo('colorWipe', 'w', ((runColorWipe, {}),), duration=5.8, cost=144),
+    PatternInfo('rainbow', 'r', ((rainbow, {}),), duration=5.1, cost=256),
+    PatternInfo('rainbowCycle', 'r', ((rainbowCycle, {}),), duration=3.8, cost=1280),
+    PatternInfo('headTieOn', None, ((headTieOn, {}),), weight=0, duration=0.6, cost=6),
+    PatternInfo('allOn', None, ((allOn, {}),), weight=0, duration=1.2, cost=12),
+    PatternInfo('allOff', None, ((allOff, {}),), weight=0, duration=1.2, cost=12),
+)
+PATTERNS_BY_NAME = dict((info.name, info) for info in PATTERN_REGISTRY)
+
+# Without a PIR, the share of turns spent resting with the lights off
+REST_SHARE = 0.25
+
+def family_enabled(family):
+    return {'a': show_a, 't': show_t, 'w': show_w, 'r': show_r}.get(family, False)
+
+def pick_pattern(rest=True):
+    # Choose the next PatternInfo for a snowman, by weight, from the
+    # enabled families. With rest, sometimes just turn the lights off
+    enabled = [info for info in PATTERN_REGISTRY if info.weight > 0 and family_enabled(info.family)]
+    if not enabled or (rest and random.random() < REST_SHARE):
+        return PATTERNS_BY_NAME['allOff']
+    return random.choices(enabled, weights=[info.weight for info in enabled])[0]
+
+# Pattern timelines
+#
+# The snowman patterns only depend on their arguments, the cheerlights
+# colour and the number of snowmen, so each one can be run once into a
+# Timeline and then replayed by copying its frames into the strip.
+# Timelines are kept in an LRU cache, which is emptied whenever the
+# cheerlights colour changes.
+
+# Maximum number of timelines kept in timeline_cache
+TIMELINE_CACHE_SIZE = 32
+
+timeline_cache = OrderedDict()
+timeline_lock = threading.Lock()
+
+class TouchedFrame(SnowmanFrame):
+    ''' Scratch framebuffer for rendering a Timeline - remembers which
+        pixels the pattern has written to.'''
+    def __init__(self):
+        SnowmanFrame.__init__(self, None, 0)
+        self.touched = set()
+
+    def setPixelColor(self, n, color):
+        SnowmanFrame.setPixelColor(self, n, color)
+        self.touched.add(n)
+
+    def setPixels(self, n, colors):
+        SnowmanFrame.setPixels(self, n, colors)
+        self.touched.update(range(n, n + len(colors)))
+
+class Timeline:
+    ''' Every frame shown by a pattern on a single snowman, packed into
+        a uint32 array, with the milliseconds to hold each frame.
+        A pattern only owns the pixels it has written, so each frame
+        also records which pixels are valid so far, and only those
+        are copied when the frame is drawn.'''
+    def __init__(self, pattern, *pargs, **kwargs):
+        self.name = pattern.__name__
+        self.frames = array.array('I')
+        self.delays = array.array('d')
+        self.valid = []
+        scratch = TouchedFrame()
+        steps = pattern(scratch, 0, *pargs, **kwargs)
+        # Same rules as play(): zero-wait steps merge into the next frame
+        pending = False
+        for wait_ms in steps:
+            pending = True
+            if wait_ms:
+                self.add_frame(scratch, wait_ms)
+                pending = False
+        if pending:
+            self.add_frame(scratch, 0)
+        # Writes after the last frame are left in the framebuffer, unshown
+        self.tail = array.array('I', scratch.pixels)
+        self.tail_valid = tuple(sorted(scratch.touched))
+
+    def add_frame(self, scratch, wait_ms):
+        self.frames.extend(scratch.pixels)
+        self.delays.append(wait_ms)
+        valid = tuple(sorted(scratch.touched))
+        # Share the tuple with the previous frame if nothing new was touched
+        if self.valid and self.valid[-1] == valid:
+            valid = self.valid[-1]
+        self.valid.append(valid)
+
+    def __len__(self):
+        return len(self.delays)
+
+    def draw(self, strip, baseLED, pixels, valid):
+        if len(valid) == LED_COUNT:
+            strip.setPixels(baseLED, pixels)
+        else:
+            for i in valid:
+                strip.setPixelColor(baseLED+i, pixels[i])
+
+    def replay(self, strip, baseLED, timer):
+        ''' Show every frame on the snowman at baseLED, yielding the
+            seconds to sleep after each one, and timing them with timer.'''
+        last = len(self.delays) - 1
+        for f in range(len(self.delays)):
+            # Frames are complete, so a late one can just be dropped,
+            # but the last frame is always shown
+            if f < last and timer.late(self.delays[f]):
+                timer.skip()
+            else:
+                self.draw(strip, baseLED, self.frames[f*LED_COUNT:(f+1)*LED_COUNT], self.valid[f])
+                timer.shown(strip.show())
+            if self.delays[f]:
+                yield timer.next_deadline(self.delays[f])
+                timer.woke()
+        self.draw(strip, baseLED, self.tail, self.tail_valid)
+
+def get_timeline(pattern, *pargs, **kwargs):
+    # Return the Timeline for a pattern, rendering it if it isn't cached.
+    # cheercolour can't change while timeline_lock is held (see
+    # set_cheercolour()), so a timeline is all rendered in one colour.
+    with timeline_lock:
+        key = (pattern.__name__, pargs, tuple(sorted(kwargs.items())), cheercolour, args.m)
+        timeline = timeline_cache.get(key)
+        if timeline is not None:
+            timeline_cache.move_to_end(key)
+            return timeline
+        timeline = Timeline(pattern, *pargs, **kwargs)
+        timeline_cache[key] = timeline
+        while len(timeline_cache) > TIMELINE_CACHE_SIZE:
+            timeline_cache.popitem(last=False)
+        return timeline
+
+def set_cheercolour(colour):
+    # Publish a new cheerlights colour to the patterns, dropping the
+    # timelines rendered with the old one in the same step.
+    # Return True if the colour changed
     global cheercolour
-    # Set up list for the leds to be held on for somecycles
-    hold_leds = []
-    # Max size of that list
-    hold_max = 2 * args.m
-    for snowman in range(args.m):
+    with timeline_lock:
+        if colour == cheercolour:
+            return False
+        cheercolour = colour
+        timeline_cache.clear()
+    return True
+
+def load_cheercolour():
+    # Show the last colour received before a restart, if there was one
+    try:
+        with open(colourfile, 'r') as f:
+            set_cheercolour(int(f.read().strip(), 16))
+    except (OSError, ValueError):
+        pass
+
+def save_cheercolour(colour):
+    # Write the colour to a new file and rename it over the old one, so
+    # the file always holds a whole colour
+    try:
+        with open(colourfile + '.new', 'w') as f:
+            f.write("%06x\n" % colour)
+        os.replace(colourfile + '.new', colourfile)
+    except OSError as e:
+        if verbose >= 1:
+            print("Could not save cheerlights colour to %s: %s" % (colourfile, e))
+
+# State of the connection to cheerlights
+mqttstate = "disconnected"
+
+def start_cheerlights(host, port):
+    # Thread to load the MQTT client and connect to cheerlights, so the
+    # lights don't wait for either
+    global mqttstate
+    begun = time.perf_counter()
+    paho = lazy_import('paho.mqtt.client')
+    if paho is None:
+        print("Could not load paho.mqtt module - no cheerlights colours")
+        return
+
+    # Channels "color", "colour" or "hex"
+    mytopic = "hex"
+
+    # Supported Colors:
+    #   red (#FF0000)
+    #   green (#008000)
+    #   blue (#0000FF)
+    #   cyan (#00FFFF)
+    #   white (#FFFFFF)
+    #   oldlace (#FDF5E6)
+    #   purple (#800080)
+    #   magenta (#FF00FF)
+    #   yellow (#FFFF00)
+    #   orange (#FFA500)
+    #   pink (#FFC0CB)
+
+    def on_message(client, userdata, message):
+        # Called if a message is received - set the color from the message text
+        global mqttstate
+        try:
+            cheermsg = message.payload.decode("utf-8")
+            if verbose >= 1:
+                print("Cheercolour = %s" % cheermsg)
+            newcolour = int(cheermsg[1:], 16)
+        except:
+            newcolour = GREEN
+        if set_cheercolour(newcolour):
+            save_cheercolour(newcolour)
+        # paho timestamps each message (on time.monotonic()) as it arrives
+        if metrics is not None and hasattr(message, 'timestamp'):
+            metrics.observe('snowrgb_cheerlights_lag_seconds', time.monotonic() - message.timestamp)
+        if verbose >= 2:
+            print("Cheercolour = 0x%x" % cheercolour)
+
+        #if verbose >= 2:
+        #    print("%s Topic %s, mid %d, Payload: %s" %
+        #          (datenow(), message.topic, message.mid, cheermsg))
+
+
+    def on_connect(client, userdata, flags, rc):
+        # Called if a connection is made
+        global mqttstate
+        if verbose >= 1:
+            print("%s Connection returned %d: %s" %
+                  (datenow(), rc, paho.connack_string(rc)))
+        if mqttstate == "starting":
+            startup_phase("cheerlights connected", begun)
+        mqttstate = "connected"
+        rc, mid = client.subscribe(mytopic, 0)
+        if verbose >= 1:
+            print("Return code from subscribe to %s = %d" % (mytopic, rc))
+
+    def on_disconnect(client, userdata, rc):
+        # Called if the connection drops - the client reconnects by itself
+        global mqttstate
+        if verbose >= 1:
+            print("%s Disconnected from %s (%d), retrying" % (datenow(), host, rc))
+        mqttstate = "disconnected"
+
+    mqttstate = "starting"
+    cheer = paho.Client()
+
+    # Set up the "message" handler
+    cheer.on_message = on_message
+    cheer.on_connect = on_connect
+    cheer.on_disconnect = on_disconnect
+
+    # Open the connection to the Cherlights server in the background,
+    # so the lights start without waiting for the network. If it fails
+    # (or drops later), retry after 1 second, doubling up to 2 minutes
+    cheer.reconnect_delay_set(min_delay=1, max_delay=120)
+    cheer.connect_async(host, port, 60)
+
+    # The on_connect handler subscribes, so that if connection drops
+    # and reconnects, it will subscribe again
+    cheer.loop_start()
+    startup_phase("cheerlights client started", begun)
+
+def play_cached(strip, baseLED, pattern, *pargs, **kwargs):
+    ''' Show pattern(strip, baseLED, *pargs, **kwargs) on one snowman,
+        by replaying its cached Timeline.
+        Return the number of frames shown.'''
+    timer = FrameTimer()
+    strip = timer.profile(strip, pattern.__name__)
+    timeline = get_timeline(pattern, *pargs, **kwargs)
+    for secs in timeline.replay(strip, baseLED, timer):
+        if secs > 0:
+            clock.sleep(secs)
+        if pattern_requests.get(baseLED // LED_COUNT) or (stream is not None and stream.active):
+            # Make way for a pattern asked for by --control, or a stream.
+            # replay() would have called woke() on carrying on
+            timer.woke()
+            break
+    count_frames(timeline.name, timer.finish())
+    return timer.stats.shows
+
+async def play_cached_async(strip, baseLED, pattern, *pargs, **kwargs):
+    # play_cached() for asyncio tasks
+    timer = FrameTimer()
+    strip = timer.profile(strip, pattern.__name__)
+    timeline = get_timeline(pattern, *pargs, **kwargs)
+    for secs in timeline.replay(strip, baseLED, timer):
+        await asyncio.sleep(secs)
+        if pattern_requests.get(baseLED // LED_COUNT) or (stream is not None and stream.active):
+            timer.woke()
+            break
+    count_frames(timeline.name, timer.finish())
+    return timer.stats.shows
+
+def all_snowmen_arms(strip, wait_ms=60, nummen=None):
+    """Run a trail of lights out along the arms of every snowman, and back."""
+    nummen = nummen or args.m
+    # Length of the trail
+    hold_max = 2 * nummen
+    trail = Trail(hold_max + 1)
+    for snowman in range(nummen):
         baseLED = LED_COUNT*snowman
         for x in ARMS:
             strip.setPixelColor(baseLED+x, cheercolour)
-            strip.show()
-            # Add this LED to the list of ones to be turned off after a delay
-            hold_leds_add(hold_leds, baseLED, x)
-            time.sleep(wait_ms / 1000.0)
-            # Turn off LEDs after a hold_max*wait_ms delay
-            hold_leds = hold_leds_release(hold_leds, hold_max, strip, wait_ms)
+            trail.push((baseLED+x,))
+            # Turn off the LED lit hold_max steps ago
+            trail.release(strip, hold_max)
+            yield wait_ms
     # Drain remaining LEDs, if any
-    hold_leds = hold_leds_release(hold_leds, 0, strip, wait_ms)
+    yield from trail.drain(strip, wait_ms)
 
-    for snowman in range(args.m-1, -1, -1):
+    for snowman in range(nummen-1, -1, -1):
         baseLED = LED_COUNT*snowman
         for x in ARMS2:
             strip.setPixelColor(baseLED+x, cheercolour)
-            strip.show()
-            # Add this LED to the list of ones to be turned off after a delay
-            hold_leds_add(hold_leds, baseLED, x)
-            time.sleep(wait_ms / 1000.0)
-            # Turn off LEDs after a hold_max*wait_ms delay
-            hold_leds = hold_leds_release(hold_leds, hold_max, strip, wait_ms)
-    # Drain remaining LEDs, if any
-    hold_leds = hold_leds_release(hold_leds, 0, strip, wait_ms)
+            trail.push((baseLED+x,))
+            trail.release(strip, hold_max)
+            yield wait_ms
+    yield from trail.drain(strip, wait_ms)
 
 def next_color_loop(i):
     i += 1
@@ -391,105 +2031,439 @@ def next_color_loop(i):
         i = 0
     return(i, COLOR_LOOP[i])
 
-def show_vertical(strip, baseLED, vcolor, LEDs, hold_leds, hold_max, wait_ms=75):
+# Columns of LEDs in a snowman, from left to right
+VERTICALS = ((0, 1), (2, 11), (3, 4, 5, 9), (8, 10), (6, 7))
+
+def show_vertical(strip, baseLED, vcolor, LEDs, trail, hold_max):
+    # Light a column of LEDs, and turn off the one lit hold_max steps ago
     if args.e:
         vcolid = cheercolour
     else:
         vcolor, vcolid = next_color_loop(vcolor)
     for x in LEDs:
         strip.setPixelColor(baseLED+x, vcolid)
-    strip.show()
-    hold_leds_add(hold_leds, baseLED, LEDs)
+    trail.push(tuple([x+baseLED for x in LEDs]))
+    trail.release(strip, hold_max)
+    return vcolor
 
-    time.sleep(wait_ms / 1000.0)
-
-    hold_leds = hold_leds_release(hold_leds, hold_max, strip, wait_ms)
-    return vcolor, hold_leds
-
-def all_snowmen_verticals(strip, wait_ms=100):
+def all_snowmen_verticals(strip, wait_ms=150, nummen=None):
+    """Sweep columns of colour across every snowman, and back."""
+    nummen = nummen or args.m
     vcolor = 0
-    hold_leds = []
-    hold_max = args.m
-    for snowman in range(args.m):
-        baseLED = LED_COUNT*snowman
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (0, 1), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (2, 11), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (3, 4, 5, 9), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (8, 10), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (6, 7), hold_leds, hold_max)
-    hold_leds = hold_leds_release(hold_leds, 0, strip, wait_ms)
-    for snowman in range(args.m-1, -1, -1):
-        baseLED = LED_COUNT*snowman
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (6, 7), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (8, 10), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (3, 4, 5, 9), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (2, 11), hold_leds, hold_max)
-        vcolor, hold_leds = show_vertical(strip, baseLED, vcolor, (0, 1), hold_leds, hold_max)
-    hold_leds = hold_leds_release(hold_leds, 0, strip, wait_ms)
-
-def all_snowmen_horizontals(strip, wait_ms=75):
-    # Light horizontal rows across all snowmen at once
+    hold_max = nummen
+    trail = Trail(hold_max + 1)
+    for snowman in range(nummen):
+        for LEDs in VERTICALS:
+            vcolor = show_vertical(strip, LED_COUNT*snowman, vcolor, LEDs, trail, hold_max)
+            yield wait_ms
+    yield from trail.drain(strip, wait_ms)
+    for snowman in range(nummen-1, -1, -1):
+        for LEDs in reversed(VERTICALS):
+            vcolor = show_vertical(strip, LED_COUNT*snowman, vcolor, LEDs, trail, hold_max)
+            yield wait_ms
+    yield from trail.drain(strip, wait_ms)
+
+# Rows of LEDs in a snowman, from top to bottom
+HORIZONTALS = ((11, 10), (9,), (2, 5, 8), (1, 4, 7), (0, 3, 6))
+
+def all_snowmen_horizontals(strip, wait_ms=150, nummen=None):
+    """Light horizontal rows across all snowmen at once, down and back up."""
+    nummen = nummen or args.m
     vcolor = 0
-    hold_leds = []
     hold_max = 2
-    for row in (11, 10), (9,), (2, 5, 8), (1, 4, 7), (0, 3, 6):
-        if args.e:
-            vcolid = cheercolour
-        else:
-            vcolor, vcolid = next_color_loop(vcolor)
-        # Place to store the row across all snowmen
-        wholerow = ()
-        for snowman in range(args.m):
-            baseLED = LED_COUNT*snowman
-            for x in row:
-                strip.setPixelColor(baseLED+x, vcolid)
-            strip.show()
-            wholerow += tuple([x+baseLED for x in row])
-        # Set baseLED parameter to 0, as we've already added the relevant baseLEDs
-        hold_leds_add(hold_leds, 0, wholerow)
-        time.sleep(wait_ms / 1000.0)
-        hold_leds = hold_leds_release(hold_leds, hold_max, strip, wait_ms)
-    hold_leds = hold_leds_release(hold_leds, 0, strip, wait_ms)
-    time.sleep(wait_ms / 1000.0)
-
-    for row in (0, 3, 6), (1, 4, 7), (2, 5, 8), (9,), (11, 10):
-        if args.e:
-            vcolid = cheercolour
-        else:
-            vcolor, vcolid = next_color_loop(vcolor)
-        wholerow = ()
-        for snowman in range(args.m):
-            baseLED = LED_COUNT*snowman
-            for x in row:
-                strip.setPixelColor(baseLED+x, vcolid)
-            strip.show()
-            wholerow += tuple([x+baseLED for x in row])
-        # Set baseLED parameter to 0, as we've already added the relevant baseLEDs
-        hold_leds_add(hold_leds, 0, wholerow)
-        time.sleep(wait_ms / 1000.0)
-        hold_leds = hold_leds_release(hold_leds, hold_max, strip, wait_ms)
-    hold_leds = hold_leds_release(hold_leds, 0, strip, wait_ms)
-    time.sleep(wait_ms / 1000.0)
+    trail = Trail(hold_max + 1)
+    for rows in (HORIZONTALS, tuple(reversed(HORIZONTALS))):
+        for row in rows:
+            if args.e:
+                vcolid = cheercolour
+            else:
+                vcolor, vcolid = next_color_loop(vcolor)
+            # Place to store the row across all snowmen
+            wholerow = ()
+            for snowman in range(nummen):
+                baseLED = LED_COUNT*snowman
+                for x in row:
+                    strip.setPixelColor(baseLED+x, vcolid)
+                wholerow += tuple([x+baseLED for x in row])
+            trail.push(wholerow)
+            trail.release(strip, hold_max)
+            yield wait_ms
+        yield from trail.drain(strip, wait_ms)
+        yield wait_ms
+
+def all_snowmen_off(strip, nummen=None):
+    """Turn off every snowman at once."""
+    for snowman in range(nummen or args.m):
+        yield from allOff(strip, LED_COUNT*snowman, wait_ms=0)
 
 # Snowmen in Sync patterns
-def all_snowmen_run(strip, wait_ms=100):
+def all_snowmen_patterns(strip, nummen=None):
+    # The patterns making up a synchronised display, in order.
+    # Start at the first snowman, run lights along right arm then left arm,
+    # then next one, to end, then loop back
+    # First turn all leds off
+    return ([all_snowmen_off(strip, nummen)] +
+            [all_snowmen_arms(strip, nummen=nummen) for n in range(2)] +
+            [all_snowmen_verticals(strip, nummen=nummen) for n in range(1)] +
+            [all_snowmen_horizontals(strip, nummen=nummen) for n in range(3)])
+
+def all_snowmen_run(strip, start=None, nummen=None):
+    # Play the synchronised display on nummen snowmen (default args.m),
+    # from the clock.monotonic() time start (default now). Each pattern is
+    # due when the one before was due to end, so every Pi sharing a start
+    # time (see --node) shows the same frame at the same time
     if lights_on(on_off_times):
-        # Start at the first snowman, run lights along right arm then left arm,
-        # then next one, to end, then loop back
-        # First turn all leds off
-        for snowman in range(args.m):
-            allOff(strip, LED_COUNT*snowman, wait_ms=0)
+        strip = profiled(strip)
+        if start is not None and start > clock.monotonic():
+            clock.sleep(start - clock.monotonic())
+        for steps in all_snowmen_patterns(strip, nummen):
+            timer = FrameTimer(start)
+            play(strip, steps, timer)
+            start = timer.deadline
+        clock.sleep(1.0)
+
+async def all_snowmen_run_async(strip, start=None, nummen=None):
+    # all_snowmen_run() for asyncio tasks
+    if lights_on(on_off_times):
+        strip = profiled(strip)
+        if start is not None and start > clock.monotonic():
+            await asyncio.sleep(start - clock.monotonic())
+        for steps in all_snowmen_patterns(strip, nummen):
+            timer = FrameTimer(start)
+            await play_async(strip, steps, timer)
+            start = timer.deadline
+        await asyncio.sleep(1.0)
+
+# Several Pis
+#
+# With --node, the Pis in an installation share the synchronised displays,
+# as if all of their snowmen were on one chain. One Pi is the coordinator,
+# and the rest are followers; they talk in JSON over UDP multicast, so
+# several copies of the program on one machine can stand in for them.
+#
+# Each follower pings the coordinator every PING_INTERVAL seconds, and
+# works out the offset of the coordinator's clock from its own (NTP-style,
+# from the ping with the fastest round trip of the last few). When it is
+# time for a synchronised display, the coordinator sends "prepare"; every
+# Pi stops its snowmen, and the followers reply "ready". The coordinator
+# then sends "start", with a time SYNC_LEAD seconds ahead on its own clock
+# and the length of the whole chain. Every Pi plays the display from that
+# time, converted to its own clock, showing just its own snowmen.
+
+NODE_GROUP = '239.255.77.77:7777'   # Default multicast group and port
+PING_INTERVAL = 1.0      # Seconds between a follower's pings
+PING_SAMPLES = 8         # Pings to pick the fastest round trip from
+SYNC_LEAD = 0.3          # Seconds between "start" and the display starting
+SYNC_READY_WAIT = 10.0   # Longest a Pi waits for the others to be ready
+
+# The SyncNode for --node, if given
+node = None
+
+class NodeStrip:
+    ''' The whole installation's chain, as seen by one Pi: writes to other
+        Pis' snowmen are dropped, and the rest go to this Pi's chain.'''
+    def __init__(self, strip, first, nummen):
+        self.strip = strip
+        self.first = first * LED_COUNT
+        self.count = nummen * LED_COUNT
+
+    def setPixelColor(self, n, color):
+        n -= self.first
+        if 0 <= n < self.count:
+            self.strip.setPixelColor(n, color)
+
+    def getPixelColor(self, n):
+        n -= self.first
+        if 0 <= n < self.count:
+            return self.strip.getPixelColor(n)
+        return BLACK
+
+    def show(self):
+        return self.strip.show()
+
+class SyncNode:
+    ''' This Pi's part in a synchronised display across several Pis (--node).
+        first is the number of this Pi's first snowman in the whole chain.'''
+    def __init__(self, role, group, first, nummen):
+        self.coordinator = role == 'coordinator'
+        try:
+            host, port = group.rsplit(':', 1)
+            self.group = (host, int(port))
+            socket.inet_aton(host)
+        except (ValueError, OSError):
+            print("Invalid multicast group %s - should be ADDRESS:PORT" % group)
+            sys.exit(1)
+        self.first = first
+        self.nummen = nummen
+        self.id = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.cond = threading.Condition()
+        # Coordinator: follower id -> (time of last ping, first, nummen)
+        self.followers = {}
+        # Coordinator: the followers ready for this round, and those which
+        # can't join it
+        self.ready = set()
+        self.declined = set()
+        # The display being arranged, and (follower) its start message
+        self.round = None
+        self.rounds = 0
+        self.start_msg = None
+        # Follower: (round trip, offset) for recent pings, and the
+        # coordinator's clock minus ours
+        self.samples = deque(maxlen=PING_SAMPLES)
+        self.offset = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind(('', self.group[1]))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                 socket.inet_aton(host) + socket.inet_aton('0.0.0.0'))
+        except OSError as e:
+            print("Could not join multicast group %s: %s" % (group, e))
+            sys.exit(1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def start(self):
+        # Start listening, and (followers) pinging
+        targets = [self.receive] if self.coordinator else [self.receive, self.ping]
+        for target in targets:
+            x = threading.Thread(target=target, name='node-' + target.__name__)
+            x.daemon = True
+            x.start()
+
+    def send(self, kind, **msg):
+        msg['kind'] = kind
+        msg['from'] = self.id
+        try:
+            self.sock.sendto(json.dumps(msg).encode('utf-8'), self.group)
+        except OSError as e:
+            if verbose >= 1:
+                print("Could not send %s to %s:%d: %s" % ((kind,) + self.group + (e,)))
 
-        for n in range(2):
-            all_snowmen_arms(strip)
-        for n in range(1):
-            all_snowmen_verticals(strip)
-        for n in range(3):
-            all_snowmen_horizontals(strip)
-        time.sleep(1.0)
+    def ping(self):
+        # Follower thread - ping the coordinator every PING_INTERVAL
+        while not stopping.is_set():
+            self.send('ping', t0=clock.monotonic(), first=self.first, men=self.nummen)
+            time.sleep(PING_INTERVAL)
+
+    def receive(self):
+        # Thread to handle messages from the other Pis
+        failing = False
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError as e:
+                # e.g. the network has gone down - say so once, and keep trying
+                if not failing:
+                    print("%s Could not receive from %s:%d: %s" % ((datenow(),) + self.group + (e,)))
+                    failing = True
+                time.sleep(PING_INTERVAL)
+                continue
+            if failing:
+                if verbose >= 1:
+                    print("%s Receiving from %s:%d again" % ((datenow(),) + self.group))
+                failing = False
+            now = clock.monotonic()
+            try:
+                msg = json.loads(data.decode('utf-8'))
+                kind = msg['kind']
+                if msg['from'] == self.id or msg.get('to', self.id) != self.id:
+                    continue
+                if self.coordinator:
+                    self.coordinator_message(kind, msg, now)
+                else:
+                    self.follower_message(kind, msg, now)
+            except (ValueError, KeyError, TypeError):
+                if verbose >= 1:
+                    print("Ignoring bad message from another Pi: %r" % data[:80])
+
+    def coordinator_message(self, kind, msg, now):
+        if kind == 'ping':
+            self.send('pong', to=msg['from'], t0=msg['t0'], t1=now, t2=clock.monotonic())
+            with self.cond:
+                self.followers[msg['from']] = (now, int(msg['first']), int(msg['men']))
+        elif kind == 'ready':
+            with self.cond:
+                if msg['round'] == self.round:
+                    self.ready.add(msg['from'])
+                    self.cond.notify_all()
+        elif kind == 'decline':
+            with self.cond:
+                if msg['round'] == self.round:
+                    self.declined.add(msg['from'])
+                    self.cond.notify_all()
+
+    def follower_message(self, kind, msg, now):
+        if kind == 'pong':
+            # t0 and now are on our clock, t1 and t2 on the coordinator's
+            t0, t1, t2 = msg['t0'], msg['t1'], msg['t2']
+            self.samples.append(((now - t0) - (t2 - t1), ((t1 - t0) + (t2 - now)) / 2))
+            with self.cond:
+                self.offset = min(self.samples)[1]
+        elif kind == 'prepare':
+            with self.cond:
+                self.round = msg['round']
+                self.start_msg = None
+            sync_request.set()
+        elif kind == 'start':
+            with self.cond:
+                if msg['round'] == self.round:
+                    self.start_msg = msg
+                    self.cond.notify_all()
+
+    def announce(self):
+        # Coordinator - ask every Pi to stop its snowmen for a display
+        if self.coordinator:
+            with self.cond:
+                self.rounds += 1
+                self.round = self.rounds
+                self.ready = set()
+                self.declined = set()
+            self.send('prepare', round=self.round)
+
+    def plan(self):
+        # Once this Pi's snowmen are idle, agree the display with the other
+        # Pis. Return (first, start, nummen) for a NodeStrip and
+        # all_snowmen_run(), or None if there is no display to join
+        if self.coordinator:
+            with self.cond:
+                asked = clock.monotonic()
+                active = dict((x, f) for x, f in self.followers.items() if asked - f[0] < 3*PING_INTERVAL)
+                self.cond.wait_for(lambda: self.ready | self.declined >= set(active), SYNC_READY_WAIT)
+                if verbose >= 2:
+                    print("%d of %d other Pis ready (%d declined) after %.2f seconds" %
+                          (len(self.ready & set(active)), len(active),
+                           len(self.declined & set(active)), clock.monotonic() - asked))
+                nummen = max([self.first + self.nummen] + [f[1] + f[2] for f in active.values()])
+                start = clock.monotonic() + SYNC_LEAD
+            self.send('start', round=self.round, at=start, men=nummen)
+            return self.first, start, nummen
+        with self.cond:
+            if self.round is None:
+                # Not asked for by the coordinator (e.g. --control) - just
+                # show this Pi's snowmen
+                return 0, None, self.nummen
+            if self.offset is None:
+                # Can't start in step without a clock offset, so tell the
+                # coordinator not to wait for us
+                self.send('decline', round=self.round)
+                self.round = None
+                return None
+            self.send('ready', round=self.round)
+            self.cond.wait_for(lambda: self.start_msg is not None, SYNC_READY_WAIT + SYNC_LEAD)
+            msg, self.start_msg, self.round = self.start_msg, None, None
+            if msg is None:
+                if verbose >= 1:
+                    print("No start from the coordinator")
+                return None
+            if verbose >= 2:
+                print("Display of %d snowmen in %.3f seconds, clock offset %.4f (round trip %.4f)" %
+                      (msg['men'], msg['at'] - self.offset - clock.monotonic(), self.offset, min(self.samples)[0]))
+            return self.first, msg['at'] - self.offset, int(msg['men'])
+
+def node_display(compositor):
+    # The synchronised display, shared with the other Pis for --node.
+    # Or, if frames have started arriving for --opc, show those instead
+    if stream is not None and stream.active:
+        strip = profiled(compositor)
+        play(strip, stream_frames(strip, stream))
+        return
+    if node is None:
+        all_snowmen_run(compositor)
+        return
+    plan = node.plan()
+    if plan is not None:
+        first, start, nummen = plan
+        all_snowmen_run(NodeStrip(compositor, first, args.m), start, nummen)
+
+async def node_display_async(compositor):
+    # node_display() for asyncio tasks
+    if stream is not None and stream.active:
+        strip = profiled(compositor)
+        await play_async(strip, stream_frames(strip, stream))
+        return
+    if node is None:
+        await all_snowmen_run_async(compositor)
+        return
+    plan = await asyncio.get_running_loop().run_in_executor(None, node.plan)
+    if plan is not None:
+        first, start, nummen = plan
+        await all_snowmen_run_async(NodeStrip(compositor, first, args.m), start, nummen)
 
 # Set up configuraiton for on-off times
 
+# Seconds in a day
+DAY_SECS = 24*3600
+
+class Schedule:
+    ''' The periods when the lights are on, merged and sorted into edges
+        (seconds since midnight: on, off, on, off, ...), so bisect finds
+        whether the lights are on, and how long until that changes.
+        If the periods came from a file, refresh() re-reads it when it
+        is changed, and adds one to generation.'''
+    def __init__(self, periods, filename=None):
+        self.filename = filename
+        self.mtime = file_mtime(filename)
+        self.generation = 0
+        self.set_periods(periods)
+
+    def set_periods(self, periods):
+        self.periods = periods
+        spans = []
+        for t0, t1 in periods:
+            if t1 < t0:
+                # Runs on past midnight
+                spans += [(t0, DAY_SECS), (0, t1)]
+            else:
+                spans.append((t0, t1))
+        edges = []
+        for t0, t1 in sorted(spans):
+            if t0 >= t1:
+                continue
+            if edges and t0 <= edges[-1]:
+                # Overlaps (or follows straight on from) the previous period
+                edges[-1] = max(edges[-1], t1)
+            else:
+                edges += [t0, t1]
+        # Replaced in one go, so other threads never see half a schedule
+        self.edges = tuple(edges)
+
+    def is_on(self, secs):
+        return bisect.bisect_right(self.edges, secs) % 2 == 1
+
+    def until_change(self, secs):
+        # Seconds from secs until the lights next go on or off,
+        # or None if they never do
+        edges = self.edges
+        if not edges or edges == (0, DAY_SECS):
+            return None
+        i = bisect.bisect_right(edges, secs)
+        if i < len(edges):
+            return edges[i] - secs
+        return edges[0] + DAY_SECS - secs
+
+    def refresh(self):
+        # Re-read the config file if it has changed. Return True if it had
+        if self.filename is None:
+            return False
+        mtime = file_mtime(self.filename)
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        self.set_periods(read_periods(self.filename))
+        self.generation += 1
+        if verbose >= 1:
+            print("%s Config file %s changed, On-Off times %s" % (datenow(), self.filename, repr(self.periods)))
+        return True
+
+def file_mtime(filename):
+    # Modification time of a file, or None if there isn't one
+    try:
+        return os.stat(filename).st_mtime
+    except (OSError, TypeError):
+        return None
+
 def read_config():
     # Config text file is format:
     #   p1=08-10:00
@@ -498,208 +2472,932 @@ def read_config():
     # Time is HH, HH:MM or HH:MM:SS
     # The 'px' name is not currently parsed - code assumes that all entries
     # are time periods, and all are correctly start_time-end_time,
+    # A period can run on past midnight, e.g. p1=20-01:30
+    # Returns a Schedule, which follows any changes to the file.
 
     if args.f:
         # Force to run all day (ignore any config file)
         t0 = 3600*0 + 60*0 + 1
         t1 = 3600*23 + 60*59 + 59
-        return [(t0, t1)]
+        return Schedule([(t0, t1)])
 
     else:
-        # Try to read config file. If not present or doesn't work, use default values
+        return Schedule(read_periods(cfgfile), cfgfile)
+
+def read_periods(filename):
+    # Read the on periods from the config file, as a list of
+    # (start, end) seconds since midnight
+
+    # Try to read config file. If not present or doesn't work, use default values
+    try:
+        with open(filename, 'r') as f:
+            cfgtext = f.readlines()
+        cfgtext = [x.strip() for x in cfgtext]
+    except:
+        cfgtext = None
+
+    if verbose >= 1:
+        print("Config file %s records %s" % (filename, repr(cfgtext)))
+    if cfgtext:
         try:
-            with open(cfgfile, 'r') as f:
-                cfgtext = f.readlines()
-            cfgtext = [x.strip() for x in cfgtext]
+            pers = []
+            for per in cfgtext:
+                per1 = per.split('=')
+                per2 = per1[1].split('-')
+                pers.append((timestring_to_secs(per2[0]),timestring_to_secs(per2[1])))
+            return pers
         except:
-            cfgtext = None
+            # Reading of config file failed
+            pass
+
+    # No valid config file, so return default start and stop times
+    # Default is 8am to 10am and 4pm to 10pm
+    t0 = 3600*8 + 60*0 + 0
+    t1 = 3600*10 + 60*0 + 0
+    t2 = 3600*16 + 60*0 + 0
+    t3 = 3600*22 + 60*0 + 0
+    return [(t0, t1), (t2, t3)]
+
+def now_secs():
+    # Seconds since midnight, on the clock
+    now = clock.now()
+    return 3600*now.hour + 60*now.minute + now.second + now.microsecond / 1000000.0
+
+def lights_on(schedule):
+    # Return True if lights are supposed to be on
+    return schedule.is_on(now_secs())
+
+def lights_change(schedule):
+    # Return the seconds until the lights should next go on or off - but
+    # at most an hour, in case the wall clock is changed
+    secs = schedule.until_change(now_secs())
+    if secs is None:
+        return 3600.0
+    return min(secs, 3600.0)
+
+# PIR sensors
+#
+# Each PIR controls some of the snowmen (by default one PIR, on PIR_SENSE,
+# controls them all). The GPIO library calls edge() whenever a PIR output
+# rises or falls, so the snowmen don't poll it - an idle snowman sleeps
+# until the gate wakes it for motion.
+
+# Snowman number -> the PirZone controlling it
+pir_zones = {}
+
+# The RPi.GPIO module (or a FakeGPIO), once the PIRs are set up
+GPIO = None
+
+class PirZone:
+    ''' A PIR sensor, and the snowmen it controls'''
+    def __init__(self, pin, snowmen):
+        self.pin = pin
+        self.snowmen = list(snowmen)
+        self.motion = False
+
+    def start(self):
+        # Follow the PIR's output from now on
+        GPIO.add_event_detect(self.pin, GPIO.BOTH, callback=self.edge)
+        self.motion = GPIO.input(self.pin) == 1
+
+    def edge(self, pin):
+        # GPIO callback, in the GPIO library's thread
+        self.motion = GPIO.input(pin) == 1
+        if verbose >= 2:
+            print("PIR on GPIO%d %s" % (pin, "motion" if self.motion else "still"))
+        if self.motion and gate is not None:
+            gate.wake()
+
+def read_pir_zones(specs, nummen):
+    # Turn --pir-zone PIN=SNOWMEN options into a list of PirZones
+    if not specs:
+        return [PirZone(PIR_SENSE, range(nummen))]
+    zones = []
+    for spec in specs:
+        try:
+            pin, snowmen = spec.split('=')
+            zones.append(PirZone(int(pin), parse_snowmen(snowmen)))
+        except ValueError:
+            print("Invalid PIR zone %s - should be PIN=SNOWMEN" % spec)
+            sys.exit(1)
+    return zones
+
+def start_pir(zones, gpio):
+    # Set up the GPIO pins for the PIRs, and hand their snowmen over to
+    # them. Until the PIRs have settled (in the background) their snowmen
+    # see no motion.
+    global GPIO
+    if gpio == 'fake':
+        GPIO = FakeGPIO()
+    else:
+        import RPi.GPIO as GPIO
+
+    # Tell GPIO library to use GPIO references
+    GPIO.setmode(GPIO.BCM)
+    for zone in zones:
+        GPIO.setup(zone.pin, GPIO.IN)
+        for snowman in zone.snowmen:
+            pir_zones[snowman] = zone
+    startup_phase("PIR set up")
+    x = clock.Thread(target=settle_pir, args=(zones, time.perf_counter()))
+    x.daemon = True
+    x.start()
+
+def settle_pir(zones, begun):
+    # Thread to wait for the PIRs to settle, then follow them
+    if verbose >= 1:
+        print("Waiting for PIR to settle ...")
+
+    # Loop until PIR outputs are 0
+    # Time out after a second
+    c = 0
+    while c<10 and not stopping.is_set() and any(GPIO.input(zone.pin)==1 for zone in zones):
+        c += 1
+        clock.sleep(0.1)
 
+    for zone in zones:
+        zone.start()
         if verbose >= 1:
-            print("Config file %s records %s" % (cfgfile, repr(cfgtext)))
-        if cfgtext:
-            try:
-                pers = []
-                for per in cfgtext:
-                    per1 = per.split('=')
-                    per2 = per1[1].split('-')
-                    pers.append((timestring_to_secs(per2[0]),timestring_to_secs(per2[1])))
-                return pers
-            except:
-                # Reading of config file failed
-                pass
+            print("  PIR on GPIO%d for snowmen %s" % (zone.pin, repr(zone.snowmen)))
+    if verbose >= 1:
+        print("  Ready")
+    startup_phase("PIR ready", begun)
+
+def cleanup_gpio():
+    # Reset GPIO settings, if the PIRs were set up
+    if GPIO is not None:
+        GPIO.cleanup()
+
+class FakeGPIO:
+    ''' Stands in for the parts of the RPi.GPIO module used here, to try
+        out the PIR handling without hardware (--gpio fake). A thread for
+        each PIR pretends that someone walks past every so often.'''
+    BCM = 'BCM'
+    IN = 'IN'
+    BOTH = 'BOTH'
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
 
-        # No valid config file, so return default start and stop times
-        # Default is 8am to 10am and 4pm to 10pm
-        t0 = 3600*8 + 60*0 + 0
-        t1 = 3600*10 + 60*0 + 0
-        t2 = 3600*16 + 60*0 + 0
-        t3 = 3600*22 + 60*0 + 0
-        return [(t0, t1), (t2, t3)]
+    def setup(self, pin, direction):
+        self.levels[pin] = 0
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+        x = clock.Thread(target=self.passers_by, args=(pin,), name="PIR %d" % pin)
+        x.daemon = True
+        x.start()
+
+    def set_input(self, pin, level):
+        # Change an input, calling its callback as a real edge would
+        if self.levels[pin] != level:
+            self.levels[pin] = level
+            if self.callbacks.get(pin):
+                self.callbacks[pin](pin)
+
+    def passers_by(self, pin):
+        # Motion for 5-30 seconds, every 10-120 seconds
+        while not stopping.is_set() and not clock.finished():
+            clock.sleep(random.uniform(10, 120))
+            self.set_input(pin, 1)
+            clock.sleep(random.uniform(5, 30))
+            self.set_input(pin, 0)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+# Control socket (--control)
+#
+# Each line sent to the socket is a command, answered with "ok" or
+# "error: ...". Commands are turned into functions which are queued for
+# the compositor thread, so they take effect on the next frame:
+#   brightness N          - set the LED brightness, 0-255
+#   pattern NAME [MEN]    - play a registered pattern now, on all snowmen
+#                           or just MEN (e.g. 0-2,5)
+#   families LETTERS      - just show these pattern families (as -a, -w,
+#                           -t and -r), e.g. "families wr"
+#   sleep SECS            - seconds between displays (as -s)
+#   sync                  - start an all-snowmen display now
+
+# Snowman number -> deque of pattern names asked for, for it to play next
+pattern_requests = {}
+
+def request_pattern(name, snowmen):
+    for snowman in snowmen:
+        pattern_requests.setdefault(snowman, deque()).append(name)
+    # Wake any sleeping snowmen
+    gate.wake()
+
+def set_families(letters):
+    global show_a, show_t, show_w, show_r
+    show_a = 'a' in letters
+    show_t = 't' in letters
+    show_w = 'w' in letters
+    show_r = 'r' in letters
+
+def control_command(compositor, line):
+    # Turn a command into a function for the compositor thread to run.
+    # Raises ValueError if the command is no good
+    words = line.split()
+    if not words:
+        raise ValueError("no command")
+    command, params = words[0], words[1:]
+    if command == 'brightness' and len(params) == 1:
+        brightness = int(params[0])
+        if not 0 <= brightness <= 255:
+            raise ValueError("brightness should be 0-255")
+        return lambda: compositor.setBrightness(brightness)
+    if command == 'pattern' and 1 <= len(params) <= 2:
+        name = params[0]
+        if name not in PATTERNS_BY_NAME:
+            raise ValueError("unknown pattern %s" % name)
+        snowmen = range(args.m)
+        if len(params) == 2:
+            snowmen = parse_snowmen(params[1])
+            if not all(0 <= snowman < args.m for snowman in snowmen):
+                raise ValueError("there are only %d snowmen" % args.m)
+        return lambda: request_pattern(name, snowmen)
+    if command == 'families' and len(params) == 1:
+        letters = params[0]
+        if not set(letters) <= set('awtr'):
+            raise ValueError("families are a, w, t and r")
+        return lambda: set_families(letters)
+    if command == 'sleep' and len(params) == 1:
+        secs = float(params[0])
+        if secs < 0:
+            raise ValueError("sleep can't be negative")
+        return lambda: setattr(args, 's', secs)
+    if command == 'sync' and not params:
+        return sync_request.set
+    raise ValueError("unknown command %s" % line.strip())
+
+def start_control(path, compositor):
+    # Listen for commands on the Unix socket path
+    # Only loaded for --control, so startup doesn't pay for it
+    import socketserver
+
+    class ControlHandler(socketserver.StreamRequestHandler):
+        ''' Reads commands from a control socket connection'''
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    function = control_command(self.server.compositor, line.decode('utf-8'))
+                except (ValueError, UnicodeDecodeError) as e:
+                    self.wfile.write(("error: %s\n" % e).encode('utf-8'))
+                    continue
+                if verbose >= 1:
+                    print("%s Control: %s" % (datenow(), line.decode('utf-8').strip()))
+                self.server.compositor.command(function)
+                self.wfile.write(b"ok\n")
 
+    class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
 
-def lights_on(onofftimes):
-    # Return True if lights are supposed to be on
-    # onofftimes is list of 'HH:MM' tuples - on if between 2 times of a tuple
-    # Convert times to number of seconds
-    now = datetime.datetime.now()
-    nowt = 3600*now.hour + 60*now.minute + now.second
-    for t0, t1 in onofftimes:
-        #if nowt < t0:
-        #    # Start time is past current time - give up
-        #    # Assumes times in roder! - do not do for now
-        #    break
-        if nowt >= t0 and nowt < t1:
+    try:
+        if os.path.exists(path):
+            os.unlink(path)
+        server = ControlServer(path, ControlHandler)
+    except OSError as e:
+        print("Could not create control socket %s: %s" % (path, e))
+        sys.exit(1)
+    server.compositor = compositor
+    # A real thread, even with --simulate - it doesn't run on the clock
+    thread = threading.Thread(target=server.serve_forever, name="control")
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Streaming (--opc)
+#
+# Other lighting software can drive the snowmen directly, by sending frames
+# with Open Pixel Control (OPC) over TCP. Each message is a channel, a
+# command and a length, then the data - for command 0, an RGB triple for
+# each LED along the chain. The first frame stops the snowmen, as for a
+# synchronised display, and then the newest frame received is shown each
+# tick (FRAME_HZ), so any arriving faster than that are dropped. Once no
+# frame has arrived for STREAM_IDLE seconds, the snowmen carry on with
+# their own patterns.
+
+OPC_HEADER = struct.Struct('>BBH')
+OPC_SET_PIXELS = 0
+STREAM_IDLE = 2.0
+
+# The StreamReceiver for --opc, if given
+stream = None
+
+class StreamReceiver:
+    ''' Holds the newest frame received, until it is shown'''
+    def __init__(self, numpixels):
+        self.numpixels = numpixels
+        self.lock = threading.Lock()
+        self.data = None
+        self.last = None
+        # True from the first frame until the snowmen get the LEDs back
+        self.active = False
+
+    def put(self, data):
+        # Called by the server thread for each frame
+        if len(data) > self.numpixels * 3:
+            data = data[:self.numpixels * 3]
+        with self.lock:
+            if self.data is not None and metrics is not None:
+                metrics.inc('snowrgb_stream_frames_dropped_total')
+            self.data = data
+            self.last = clock.monotonic()
+            starting = not self.active
+            self.active = True
+        if metrics is not None:
+            metrics.inc('snowrgb_stream_frames_total')
+        if starting:
+            if verbose >= 1:
+                print("%s Stream started" % datenow())
+            sync_request.set()
+
+    def take(self):
+        # Return the newest frame as colours, or None if there isn't a new one
+        with self.lock:
+            data, self.data = self.data, None
+        if data is None:
+            return None
+        # Spread the RGB triples out into big-endian 0x00RRGGBB words,
+        # and read those as colours
+        count = len(data) // 3
+        words = bytearray(count * 4)
+        words[1::4] = data[0:count*3:3]
+        words[2::4] = data[1:count*3:3]
+        words[3::4] = data[2:count*3:3]
+        colours = array.array('I', words)
+        if sys.byteorder == 'little':
+            colours.byteswap()
+        return colours
+
+    def idle(self):
+        return self.last is None or clock.monotonic() - self.last > STREAM_IDLE
+
+def stream_frames(strip, receiver):
+    """Show the newest frame from the stream each tick, until it goes idle."""
+    try:
+        while not stopping.is_set() and not receiver.idle():
+            colours = receiver.take()
+            if colours is not None:
+                strip.setPixels(0, colours)
+            yield 1000.0 / FRAME_HZ
+    finally:
+        receiver.active = False
+        if verbose >= 1:
+            print("%s Stream idle" % datenow())
+
+def start_opc(address, numpixels):
+    # Listen for OPC frames on [HOST:]PORT
+    global stream
+    # Only loaded for --opc, so startup doesn't pay for it
+    import socketserver
+
+    class OpcHandler(socketserver.StreamRequestHandler):
+        ''' Reads Open Pixel Control messages from a connection'''
+        def handle(self):
+            while True:
+                header = self.rfile.read(OPC_HEADER.size)
+                if len(header) < OPC_HEADER.size:
+                    return
+                channel, command, length = OPC_HEADER.unpack(header)
+                data = self.rfile.read(length)
+                if len(data) < length:
+                    return
+                # Channel 0 is for every device, and we are channel 1
+                if command == OPC_SET_PIXELS and channel in (0, 1):
+                    stream.put(data)
+
+    class OpcServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    stream = StreamReceiver(numpixels)
+    try:
+        host, _, port = address.rpartition(':')
+        server = OpcServer((host or '127.0.0.1', int(port)), OpcHandler)
+    except (OSError, ValueError) as e:
+        print("Could not listen for OPC on %s: %s" % (address, e))
+        sys.exit(1)
+    # A real thread, even with --simulate - it doesn't run on the clock
+    thread = threading.Thread(target=server.serve_forever, name="opc")
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Benchmarks (--time)
+#
+# Each pattern is run on every snowman at once (or across the chain, for
+# the all_snowmen_* patterns), for 1 to args.m snowmen, and measured:
+#   nominal   - seconds the pattern asks to sleep for
+#   actual    - wall-clock seconds it took
+#   overshoot - actual - nominal (time spent working, or oversleeping)
+#   shows     - show() calls made by the compositor
+#   suppressed - frames not sent because they hadn't changed
+#   pixels    - pixels sent to the LEDs
+#   cpu       - CPU seconds used by the whole process
+#   skipped   - frames dropped because they were already late
+#   jitter    - the latest any frame was, in seconds
+
+# Patterns run on each snowman, with their arguments
+BENCH_PATTERNS = (
+    (headTieOn, {'wait_ms': 0}),
+    (spin, {}),
+    (spin2, {}),
+    (allOn, {'wait_ms': 0}),
+    (wink, {}),
+    (wink2, {}),
+    (wobble, {}),
+    (upDown, {}),
+    (runTheaterChase, {}),
+    (runColorWipe, {}),
+    (rainbow, {}),
+    (rainbowCycle, {}),
+    (allOff, {}),
+)
+
+# Measurements compared against the baseline, and the smallest increase
+# which counts as a regression (so that tiny timings don't trigger it)
+BENCH_CHECKS = (('actual', 0.05), ('cpu', 0.05), ('shows', 1), ('pixels', LED_COUNT))
+
+def bench_jobs(compositor, name, jobs):
+    # Run each job in its own thread, all at once.
+    # Return a dictionary of measurements
+    compositor.flush()
+    with pattern_lock:
+        pattern_stats.clear()
+    shows = compositor.shows
+    suppressed = compositor.suppressed
+    pixels = compositor.pixels_sent
+    cpu = time.process_time()
+    start = time.perf_counter()
+    threads = [clock.Thread(target=job) for job in jobs]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    compositor.flush()
+    actual = time.perf_counter() - start
+    shows = compositor.shows - shows
+    stats = pattern_stats.get(name, FrameStats())
+    # Every job plays the same pattern, so they have the same nominal time
+    nominal = stats.nominal / len(jobs)
+    return {
+        'pattern': name,
+        'men': len(compositor.frames),
+        'nominal': nominal,
+        'actual': actual,
+        'overshoot': actual - nominal,
+        'shows': shows,
+        'suppressed': compositor.suppressed - suppressed,
+        'pixels': compositor.pixels_sent - pixels,
+        'cpu': time.process_time() - cpu,
+        'skipped': stats.skipped,
+        'jitter': stats.jitter_max,
+    }
+
+def benchmark(outputs, maxmen):
+    ''' Measure every pattern for 1 to maxmen snowmen, printing a table.
+        Return a list of measurements, one dictionary per pattern run.'''
+    results = []
+    print("%-24s %4s %8s %8s %9s %6s %10s %8s %6s %7s %6s" %
+          ("pattern", "men", "nominal", "actual", "overshoot", "shows", "suppressed", "pixels", "cpu", "skipped", "jitter"))
+    for men in range(1, maxmen+1):
+        # The all_snowmen_* patterns use args.m for the number of snowmen
+        args.m = men
+        # Just the first men snowmen, on whichever outputs they are wired to
+        menoutputs = [Output(output.name, output.strip, [x for x in output.snowmen if x < men])
+                      for output in outputs]
+        compositor = Compositor([output for output in menoutputs if output.snowmen], men)
+        compositor.start()
+        jobs = []
+        for pattern, kwargs in BENCH_PATTERNS:
+            jobs.append((pattern.__name__, [
+                (lambda frame=profiled(frame), pattern=pattern, kwargs=kwargs:
+                    play(frame, pattern(frame, frame.baseLED, **kwargs)))
+                for frame in compositor.frames]))
+        for pattern in (all_snowmen_arms, all_snowmen_verticals, all_snowmen_horizontals):
+            jobs.append((pattern.__name__, [lambda pattern=pattern, strip=profiled(compositor):
+                                            play(strip, pattern(strip))]))
+        for name, patternjobs in jobs:
+            result = bench_jobs(compositor, name, patternjobs)
+            print("%-24s %4d %8.2f %8.2f %9.2f %6d %10d %8d %6.2f %7d %6.3f" %
+                  (name, men, result['nominal'], result['actual'], result['overshoot'],
+                   result['shows'], result['suppressed'], result['pixels'], result['cpu'],
+                   result['skipped'], result['jitter']))
+            results.append(result)
+        play(compositor, allOff(compositor, 0, wait_ms=0))
+        compositor.stop()
+    args.m = maxmen
+    return results
+
+def read_baseline(filename):
+    # Read the results saved by --time-json in filename, and check that
+    # they have everything bench_regressions() compares
+    try:
+        with open(filename, 'r') as f:
+            baseline = json.load(f)['results']
+        for old in baseline:
+            missing = [key for key in ['pattern', 'men'] + [key for key, minimum in BENCH_CHECKS]
+                       if key not in old]
+            if missing:
+                raise KeyError(missing[0])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Could not read baseline %s: %s" % (filename, e))
+        sys.exit(1)
+    return baseline
+
+def bench_regressions(results, baseline, tolerance):
+    # Compare results with a baseline list of results, and print any
+    # measurements more than tolerance (a fraction) worse than it.
+    # Return the number of regressions found
+    base = dict(((x['pattern'], x['men']), x) for x in baseline)
+    regressions = 0
+    for result in results:
+        old = base.get((result['pattern'], result['men']))
+        if old is None:
+            continue
+        for key, minimum in BENCH_CHECKS:
+            if result[key] > old[key] * (1 + tolerance) and result[key] - old[key] >= minimum:
+                print("REGRESSION %s with %d snowmen: %s %s, was %s" %
+                      (result['pattern'], result['men'], key, result[key], old[key]))
+                regressions += 1
+    return regressions
+
+class SyncGate:
+    ''' Hands the LEDs over from the snowman threads to the all-snowmen
+        display, and back again.
+        The main thread calls enter() to ask the snowmen to stop, which
+        returns once every running snowman is waiting in checkpoint(),
+        and leave() to let them all carry on.'''
+    def __init__(self, nummen):
+        self.cond = clock.Condition()
+        self.active = nummen
+        self.syncing = False
+        self.idle = 0
+        # Counts synchronised displays, so a snowman knows when its one is over
+        self.generation = 0
+
+    def enter(self):
+        # Return True when all snowmen are idle, or False if there are
+        # none left running (or we are stopping)
+        start = clock.monotonic()
+        with self.cond:
+            self.syncing = True
+            self.idle = 0
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.idle >= self.active or stopping.is_set())
+            if metrics is not None:
+                metrics.observe('snowrgb_sync_enter_seconds', clock.monotonic() - start)
+            return self.active > 0 and not stopping.is_set()
+
+    def leave(self):
+        with self.cond:
+            self.syncing = False
+            self.generation += 1
+            self.cond.notify_all()
+
+    def checkpoint(self):
+        # Called by each snowman between patterns. If a synchronised display
+        # is wanted, wait until it is over. Return True if we waited
+        with self.cond:
+            if not self.syncing:
+                return False
+            generation = self.generation
+            self.idle += 1
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.generation != generation or stopping.is_set())
             return True
-    return False
-
-def time_snowman(strip):
-    baseLED = 0 # Just do this on the first snowman
-
-    b = time.perf_counter(); headTieOn(strip, baseLED, wait_ms=0); print("%5.2f %s" % (time.perf_counter()-b, "headTieOn"))
-    b = time.perf_counter(); spin(strip, baseLED);                 print("%5.2f %s" % (time.perf_counter()-b, "spin"))
-    b = time.perf_counter(); spin2(strip, baseLED);                print("%5.2f %s" % (time.perf_counter()-b, "spin2"))
-    b = time.perf_counter(); allOn(strip, baseLED, wait_ms=0);     print("%5.2f %s" % (time.perf_counter()-b, "allOn"))
-    b = time.perf_counter(); wink(strip, baseLED);                 print("%5.2f %s" % (time.perf_counter()-b, "wink"))
-    b = time.perf_counter(); wink2(strip, baseLED);                print("%5.2f %s" % (time.perf_counter()-b, "wink2"))
-    b = time.perf_counter(); wobble(strip, baseLED);               print("%5.2f %s" % (time.perf_counter()-b, "wobble"))
-    b = time.perf_counter(); upDown(strip, baseLED);               print("%5.2f %s" % (time.perf_counter()-b, "upDown"))
-    b = time.perf_counter(); runTheaterChase(strip, baseLED);      print("%5.2f %s" % (time.perf_counter()-b, "runTheaterChase"))
-    b = time.perf_counter(); runColorWipe(strip, baseLED);         print("%5.2f %s" % (time.perf_counter()-b, "runColorWipe"))
-    b = time.perf_counter(); rainbow(strip, baseLED);              print("%5.2f %s" % (time.perf_counter()-b, "rainbow"))
-    b = time.perf_counter(); rainbowCycle(strip, baseLED);         print("%5.2f %s" % (time.perf_counter()-b, "rainbowCycle"))
-    allOff(strip, baseLED, wait_ms=0)
 
-def run_snowman(snowman,strip):
-    global insync, idlemen
+    def sleep(self, secs, until=None):
+        # Sleep between patterns, waking early if a synchronised display is
+        # wanted, or once until() is true (checked whenever wake() is called)
+        with self.cond:
+            self.cond.wait_for(lambda: self.syncing or stopping.is_set() or
+                               (until is not None and until()), secs)
+
+    def wake(self):
+        # Make sleeping snowmen check their until() - from any thread
+        with self.cond:
+            self.cond.notify_all()
+
+    def retire(self):
+        # Called when a snowman thread ends, so nobody waits for it
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+class AsyncSyncGate(SyncGate):
+    ''' SyncGate for --asyncio, where every method (except wake())
+        is a coroutine'''
+    def __init__(self, nummen):
+        SyncGate.__init__(self, nummen)
+        self.loop = asyncio.get_running_loop()
+
+    async def enter(self):
+        start = clock.monotonic()
+        async with self.cond:
+            self.syncing = True
+            self.idle = 0
+            self.cond.notify_all()
+            await self.cond.wait_for(lambda: self.idle >= self.active or stopping.is_set())
+            if metrics is not None:
+                metrics.observe('snowrgb_sync_enter_seconds', clock.monotonic() - start)
+            return self.active > 0 and not stopping.is_set()
+
+    async def leave(self):
+        async with self.cond:
+            self.syncing = False
+            self.generation += 1
+            self.cond.notify_all()
+
+    async def checkpoint(self):
+        async with self.cond:
+            if not self.syncing:
+                return False
+            generation = self.generation
+            self.idle += 1
+            self.cond.notify_all()
+            await self.cond.wait_for(lambda: self.generation != generation or stopping.is_set())
+            return True
 
+    async def sleep(self, secs, until=None):
+        async with self.cond:
+            try:
+                await asyncio.wait_for(
+                    self.cond.wait_for(lambda: self.syncing or stopping.is_set() or
+                                       (until is not None and until())), secs)
+            except asyncio.TimeoutError:
+                pass
+
+    def wake(self):
+        # Called from other threads, so hand the notify to the event loop
+        asyncio.run_coroutine_threadsafe(self.notify(), self.loop)
+
+    async def notify(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    async def retire(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+def snowman_thread(snowman, strip):
+    # Thread body for each snowman
+    try:
+        run_snowman(snowman, strip)
+    finally:
+        gate.retire()
+
+def first_light(compositor):
+    # Light every snowman straight away, rather than as each one gets going
+    for snowman in range(len(compositor.frames)):
+        play_cached(compositor.frame(snowman), snowman*LED_COUNT, allOn, wait_ms=0)
+    compositor.flush()
+    elapsed = startup_phase("first light")
+    if elapsed > STARTUP_BUDGET and (verbose >= 1 or startup_trace):
+        print("First light took %.3f seconds, more than the %.1f second budget" % (elapsed, STARTUP_BUDGET))
+
+def start_background(zones):
+    # Start the things that the first frame didn't wait for
+    if zones:
+        start_pir(zones, args.gpio)
+    if args.e:
+        x = threading.Thread(target=start_cheerlights, args=(args.mqtt_host, args.mqtt_port))
+        x.daemon = True
+        x.start()
+    if node is not None:
+        node.start()
+    if args.opc:
+        start_opc(args.opc, args.m * LED_COUNT)
+
+def snowmen_running(threadlist):
+    # Return True while any snowman thread is still running
+    # (the compositor thread doesn't count)
+    return any(x.is_alive() for x in threadlist)
+
+# Actions yielded by snowman_actions()
+PLAY = 'play'              # (PLAY, pattern, kwargs) - play a pattern on the snowman
+PAUSE = 'pause'            # (PAUSE, secs) - just wait
+SLEEP = 'sleep'            # (SLEEP, secs[, until]) - wait, but stop early for a synchronised
+                           # display, or when until() is true
+CHECKPOINT = 'checkpoint'  # (CHECKPOINT,) - wait while a synchronised display runs
+
+# The startup demo, which follows first_light() unless -q
+DEMO_ACTIONS = (
+    (PLAY, allOn, {}),
+    (PLAY, wobble, {}),
+    (PLAY, upDown, {}),
+    (PLAY, upDown, {}),
+    (PLAY, wink, {}),
+    (PLAY, wink2, {}),
+    (PLAY, allOff, {}),
+    (PLAY, headTieOn, {}),
+    (PLAY, spin, {}),
+    (PLAY, spin2, {}),
+    (PLAY, allOff, {}),
+    (PAUSE, 1.0),
+    (PLAY, allOn, {'wait_ms': 0.0}),
+    (PAUSE, 1.0),
+    (PLAY, allOff, {'wait_ms': 0.0}),
+)
+
+def snowman_actions(snowman):
+    ''' Everything the nth snowman in the chain does, as a generator of
+        actions. run_snowman() carries them out in a thread, and
+        run_snowman_async() as an asyncio task.'''
     if verbose >= 1:
         print("Snowman %d start" % (snowman))
-    # Run nth snowman in chain
-    baseLED = snowman * LED_COUNT
 
     Current_State  = 0
     Previous_State = 0
+    zone = pir_zones.get(snowman)
+    requests = pattern_requests.setdefault(snowman, deque())
+
+    def wanted():
+        # True if the snowman should stop sleeping - for motion on its
+        # PIR, or a pattern asked for by --control
+        return bool(requests) or (zone is not None and zone.motion)
 
     # === stop lights on this snowman and exit ===
     if args.o:
-        allOff(strip, baseLED, wait_ms=0)
+        yield (PLAY, allOff, {'wait_ms': 0})
         return
 
     # ==== Initial display begins ====
+    # first_light() has already lit every snowman, so just stagger the
+    # start of the demo along the chain. Stop between steps for any
+    # synchronised display, rather than making it wait for the whole demo.
     if not args.q:
-        allOn(strip, baseLED)
-        wobble(strip, baseLED)
-        upDown(strip, baseLED)
-        upDown(strip, baseLED)
-        wink(strip, baseLED)
-        wink2(strip, baseLED)
-        allOff(strip, baseLED)
-        headTieOn(strip, baseLED)
-        spin(strip, baseLED)
-        spin2(strip, baseLED)
-        allOff(strip, baseLED)
-        time.sleep(1.0)
-        allOn(strip, baseLED, wait_ms=0.0)
-        time.sleep(1.0)
-        allOff(strip, baseLED, wait_ms=0.0)
-
-
-    try:
-        while True:
-          try:
-            # If We are in the Synchronized state, tell main thread that we are ready
-            # and just loop unti the insync flag is turned off
-            if insync:
-                idlemen += 1
-                while insync:
-                    time.sleep(0.2)
-
-
-            # We are not in a synchronised state - show lights (if it's the right time)
-            if lights_on(on_off_times):
-
-                # we are in a display time - show lights
-                if args.p:
-                    Current_State = GPIO.input(sw)
-                else:
-                    # No PIR - just toggle to pause between displays
-                    if Current_State == 0:
-                        Current_State = args.n
-                    else:
-                        Current_State -= 1
-
-                if Current_State>=1:
-                    # PIR is triggered
-                    if Previous_State==0:
-                        if verbose >= 2:
-                            print("  Motion detected!")
-                        allOn(strip, baseLED)
-                        Previous_State=1
-                    if args.p:
-                        # PIR-driven - always display a pattern
-                        n = random.randint(0,9)
-                    else:
-                        # Fixed - only display 75% of time
-                        n = random.randint(0,15)
-                    if n == 0 and show_a:
-                        headTieOn(strip, baseLED, wait_ms=0)
-                        spin(strip, baseLED)
-                    if n == 1 and show_a:
-                        headTieOn(strip, baseLED, wait_ms=0)
-                        spin2(strip, baseLED)
-                    if n == 2 and show_a:
-                        allOn(strip, baseLED, wait_ms=0)
-                        wink(strip, baseLED)
-                    if n == 3 and show_a:
-                        allOn(strip, baseLED, wait_ms=0)
-                        wink2(strip, baseLED)
-                    if n == 4 and show_a:
-                        headTieOn(strip, baseLED, wait_ms=0)
-                        wobble(strip, baseLED)
-                    if n == 5 and show_a:
-                        upDown(strip, baseLED)
-                    if n == 6 and show_t:
-                        runTheaterChase(strip, baseLED)
-                    if n == 7 and show_w:
-                        runColorWipe(strip, baseLED)
-                    if n == 8 and show_r:
-                        rainbow(strip, baseLED)
-                    if n == 9 and show_r:
-                        rainbowCycle(strip, baseLED)
-                    if n >  9:
-                        allOff(strip, baseLED)
-
-                elif Current_State==0:
-                    if Previous_State==1:
-                        # PIR has returned to ready state
-                        if verbose >= 2:
-                            print("  Idle")
-                        Previous_State=0
-                        allOff(strip, baseLED)
-                    # Sleep between displays
-                    time.sleep(args.s)
+        yield (SLEEP, snowman * STARTUP_STAGGER)
+        for action in DEMO_ACTIONS:
+            yield (CHECKPOINT,)
+            if stopping.is_set():
+                return
+            yield action
+
+    while not stopping.is_set():
+        # If a synchronised display is wanted, tell main thread that we are
+        # ready, and wait until it is over
+        yield (CHECKPOINT,)
+
+        # Play any patterns asked for by --control, whatever the time
+        while requests and not stopping.is_set():
+            for pattern, kwargs in PATTERNS_BY_NAME[requests.popleft()].steps:
+                yield (PLAY, pattern, kwargs)
+            Previous_State = 1
+
+        # We are not in a synchronised state - show lights (if it's the right time)
+        if lights_on(on_off_times):
+
+            # we are in a display time - show lights
+            if zone is not None:
+                Current_State = 1 if zone.motion else 0
             else:
-                # We are in "off" time - if lights on, turn them off,
-                # if not on, leve them alone
+                # No PIR - just toggle to pause between displays
+                if Current_State == 0:
+                    Current_State = args.n
+                else:
+                    Current_State -= 1
+
+            if Current_State>=1:
+                # PIR is triggered
+                if Previous_State==0:
+                    if verbose >= 2:
+                        print("  Motion detected!")
+                    yield (PLAY, allOn, {})
+                    Previous_State=1
+                # PIR-driven - always display a pattern.
+                # Fixed - only display 75% of time (see REST_SHARE)
+                for pattern, kwargs in pick_pattern(rest=zone is None).steps:
+                    yield (PLAY, pattern, kwargs)
+
+            elif Current_State==0:
                 if Previous_State==1:
-                    # Lights were on - turn them off
+                    # PIR has returned to ready state
                     if verbose >= 2:
-                        print("  Dark")
+                        print("  Idle")
                     Previous_State=0
-                    allOff(strip, baseLED)
-                    time.sleep(30.0)
-          except KeyboardInterrupt:
-            if verbose >= 1:
-                print("Keyboard interrupt in thread for snowman %d" % snowman)
-            break
+                    yield (PLAY, allOff, {})
+                # Sleep between displays - the PIR (if any) wakes us for motion
+                yield (SLEEP, args.s, wanted)
+        else:
+            # We are in "off" time - if lights on, turn them off,
+            # if not on, leve them alone
+            if Previous_State==1:
+                # Lights were on - turn them off
+                if verbose >= 2:
+                    print("  Dark")
+                Previous_State=0
+                yield (PLAY, allOff, {})
+            # Sleep until the lights are due on, the config file changes or
+            # --control asks for a pattern. Motion on the PIR is ignored
+            # until the lights are due on
+            generation = on_off_times.generation
+            yield (SLEEP, lights_change(on_off_times), lambda: on_off_times.generation != generation or bool(requests))
 
+def run_snowman(snowman,strip):
+    # Run nth snowman in chain, in this thread
+    baseLED = snowman * LED_COUNT
+    profile_stack.set(('snowman%d' % snowman,))
+    try:
+        for action in snowman_actions(snowman):
+            if action[0] == PLAY:
+                play_cached(strip, baseLED, action[1], **action[2])
+            elif action[0] == PAUSE:
+                clock.sleep(action[1])
+            elif action[0] == SLEEP:
+                gate.sleep(*action[1:])
+            elif action[0] == CHECKPOINT:
+                gate.checkpoint()
 
     except KeyboardInterrupt:
+        if verbose >= 1:
+            print("Keyboard interrupt in thread for snowman %d" % snowman)
         # Reset GPIO settings
-        if args.p:
-            GPIO.cleanup()
-        allOff(strip, baseLED)
-        return
+        cleanup_gpio()
+        play_cached(strip, baseLED, allOff)
+
+async def run_snowman_async(snowman, strip):
+    # Run nth snowman in chain, as an asyncio task
+    baseLED = snowman * LED_COUNT
+    profile_stack.set(('snowman%d' % snowman,))
+    try:
+        for action in snowman_actions(snowman):
+            if action[0] == PLAY:
+                await play_cached_async(strip, baseLED, action[1], **action[2])
+            elif action[0] == PAUSE:
+                await asyncio.sleep(action[1])
+            elif action[0] == SLEEP:
+                await gate.sleep(*action[1:])
+            elif action[0] == CHECKPOINT:
+                await gate.checkpoint()
+    finally:
+        await gate.retire()
+
+async def main_async(outputs, zones, recorder=None):
+    ''' Run every snowman, the compositor and the all-snowmen displays
+        as tasks on one event loop (--asyncio)'''
+    global clock, stopping, sync_request, gate
+    clock = AsyncClock()
+    stopping = clock.Event()
+    sync_request = clock.Event()
+    gate = AsyncSyncGate(args.m)
+    compositor = Compositor(outputs, args.m)
+    if args.control:
+        start_control(args.control, compositor)
+    compositor.recorder = recorder
+    compositor_task = asyncio.create_task(compositor.run_async())
+    if not (args.q or args.o):
+        first_light(compositor)
+    start_background(zones)
+    tasks = []
+    try:
+        # Start the individual snowmen
+        for snowman in range(args.m):
+            tasks.append(asyncio.create_task(run_snowman_async(snowman, compositor.frame(snowman))))
+        startup_phase("snowmen started")
+
+        # Every args.l seconds (or when asked by --control), do a synchronized display
+        while not all(x.done() for x in tasks):
+            sync_wait = asyncio.ensure_future(sync_request.wait())
+            # A follower waits for the coordinator to ask for each display
+            timeout = args.l if node is None or node.coordinator else None
+            await asyncio.wait(tasks + [sync_wait], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            sync_wait.cancel()
+            sync_request.clear()
+            if all(x.done() for x in tasks):
+                break
+            if on_off_times.refresh():
+                gate.wake()
+            if node is not None and not (stream is not None and stream.active):
+                node.announce()
+            if verbose >= 2:
+                print("Wait for all snowmen to be idle")
+            if await gate.enter():
+                if verbose >= 2:
+                    print("All snowmen idle - do centralised display")
+                await node_display_async(compositor)
+            await gate.leave()
+            if verbose >= 2:
+                print("Out of sync")
+    finally:
+        stopping.set()
+        await gate.leave()
+        for x in tasks:
+            x.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        compositor.running = False
+        compositor_task.cancel()
+        compositor.flush()
 
 if __name__ == '__main__':
     # Process arguments
@@ -719,10 +3417,37 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--men', action='store', dest='m', type=int, default=1, help='Number of snowmen, default %(default)s')
     parser.add_argument('-f', '--forever', action='store_true', dest='f', help='Run all day, ignore time limits')
     parser.add_argument('-p', '--pir', action='store_true', dest='p', help='PIR is present')
+    parser.add_argument('--pir-zone', action='append', dest='pir_zones', metavar='PIN=SNOWMEN', help='A PIR on GPIO PIN controls SNOWMEN (e.g. 0-4,7) - may be repeated, implies -p')
+    parser.add_argument('--gpio', action='store', dest='gpio', choices=('rpi', 'fake'), default='rpi', help='GPIO for the PIR: rpi (the real pins) or fake (random motion, no hardware), default %(default)s')
     parser.add_argument('-e', '--cheerlights', action='store_true', dest='e', help='Cheerlights connection via MQTT')
+    parser.add_argument('--mqtt-host', action='store', dest='mqtt_host', metavar='HOST', default='mqtt.cheerlights.com', help='MQTT broker for cheerlights colours, default %(default)s')
+    parser.add_argument('--mqtt-port', action='store', dest='mqtt_port', metavar='PORT', type=int, default=1883, help='MQTT broker port, default %(default)s')
     parser.add_argument('-v', '--verbose', action='count',  default=0, dest='v', help='Verbose logging (repeat for more verbose')
-    parser.add_argument('--time', action='store_true', dest='time', help='Just time each display method')
+    parser.add_argument('--time', action='store_true', dest='time', help='Just time each display method, for 1 to M snowmen')
+    parser.add_argument('--time-json', action='store', dest='time_json', metavar='FILE', help='With --time, write the results to FILE as JSON')
+    parser.add_argument('--time-baseline', action='store', dest='time_baseline', metavar='FILE', help='With --time, report regressions against results saved by --time-json')
+    parser.add_argument('--time-tolerance', action='store', dest='time_tolerance', metavar='PCT', type=float, default=10.0, help='With --time-baseline, percentage increase counted as a regression, default %(default)s')
+    parser.add_argument('--backend', action='store', dest='backend', choices=BACKENDS, default='ws281x', help='LED output: ws281x (the real LEDs), null or record (no hardware), default %(default)s')
+    parser.add_argument('--output-process', action='store_true', dest='output_process', help='Drive the LEDs from a separate process, fed through shared memory')
+    parser.add_argument('--outputs', action='store', dest='outputs', metavar='FILE', help='Read which snowmen are on which LED output (strip) from FILE, instead of one --backend strip')
+    parser.add_argument('--record', action='store', dest='record', metavar='FILE', help='Record every frame sent to the LEDs in FILE')
+    parser.add_argument('--replay', action='store', dest='replay', metavar='FILE', help='Just play back the frames recorded in FILE by --record')
+    parser.add_argument('--metrics', action='store', dest='metrics', metavar='[HOST:]PORT|PATH', help='Serve Prometheus metrics over HTTP on PORT (HOST defaults to 127.0.0.1), or on the Unix socket PATH')
+    parser.add_argument('--profile', action='store', dest='profile', metavar='FILE', help='Profile the patterns, writing flamegraph stacks to FILE and printing a summary on exit')
+    parser.add_argument('--control', action='store', dest='control', metavar='PATH', help='Take commands (brightness, pattern, families, sleep, sync) on the Unix socket PATH')
+    parser.add_argument('--opc', action='store', dest='opc', metavar='[HOST:]PORT', help='Show frames sent with Open Pixel Control to TCP PORT (HOST defaults to 127.0.0.1), going back to the patterns when they stop')
+    parser.add_argument('--node', action='store', dest='node', choices=('coordinator', 'follower'), help='Share the all-snowmen displays with other Pis, as the coordinator or a follower')
+    parser.add_argument('--node-group', action='store', dest='node_group', metavar='ADDRESS:PORT', default=NODE_GROUP, help='With --node, the UDP multicast group for the Pis, default %(default)s')
+    parser.add_argument('--node-first', action='store', dest='node_first', metavar='N', type=int, default=0, help="With --node, the number of this Pi's first snowman among all of the Pis' snowmen, default %(default)s")
+    parser.add_argument('--startup-trace', action='store_true', dest='startup_trace', help='Print how long each step of starting up takes')
+    parser.add_argument('--simulate', action='store', dest='simulate', metavar='START-END', help='Run the schedule from START to END (HH[:MM[:SS]]) on a simulated clock, with no hardware')
+    parser.add_argument('--asyncio', action='store_true', dest='asyncio', help='Run all of the snowmen as asyncio tasks in one thread, instead of a thread each')
+    parser.add_argument('--speed', action='store', dest='speed', type=float, default=0, help='With --simulate, run at most this many times faster than real time, default %(default)s (as fast as possible)')
     args = parser.parse_args()
+    startup_trace = args.startup_trace
+    startup_phase("imports and arguments")
+    if args.pir_zones:
+        args.p = True
 
     # Set flags for things to display
     show_a = args.a
@@ -733,6 +3458,11 @@ if __name__ == '__main__':
     # if none specified, set all
     if not (args.a or args.t or args.r or args.w):
         show_a = show_t = show_r = show_w = True
+    if verbose >= 2:
+        for info in PATTERN_REGISTRY:
+            if family_enabled(info.family):
+                print("Pattern %-14s family %s, weight %.1f, about %.1f seconds and %d frames" %
+                      (info.name, info.family, info.weight, info.duration, info.cost))
     if verbose >= 1:
         msg = ''
         if args.p:
@@ -743,165 +3473,182 @@ if __name__ == '__main__':
             msg += ', running continuously'
         print("Starting %d snowmen%s, verbosity %d" % (args.m, msg, verbose))
 
+    # A replay shows however many snowmen were recorded
+    if args.replay:
+        if args.record or args.simulate:
+            print("--replay can't be used with --record or --simulate")
+            sys.exit(1)
+        recording = Recording(args.replay)
+        args.m = recording.nummen
+
+    # ==== Set up simulated clock ====
+    if args.simulate:
+        try:
+            simstart, simend = [timestring_to_secs(x) for x in args.simulate.split('-')]
+        except ValueError:
+            print("Invalid simulation period %s - should be START-END" % args.simulate)
+            sys.exit(1)
+        if simend <= simstart:
+            # Run on past midnight
+            simend += 24*3600
+        if args.p and args.gpio != 'fake':
+            print("Only a '--gpio fake' PIR can be used with --simulate")
+            sys.exit(1)
+        if args.asyncio:
+            print("--asyncio can't be used with --simulate")
+            sys.exit(1)
+        if args.node:
+            print("--node can't be used with --simulate")
+            sys.exit(1)
+        midnight = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        clock = VirtualClock(midnight + datetime.timedelta(seconds=simstart),
+                             midnight + datetime.timedelta(seconds=simend), args.speed)
+        stopping = clock.Event()
+        sync_request = clock.Event()
+        # Never drive the real LEDs from a simulation
+        if args.backend == 'ws281x':
+            args.backend = 'null'
+        realstart = time.perf_counter()
+
+    if args.metrics:
+        start_metrics(args.metrics)
+    if args.profile:
+        profiler = Profiler()
+
     # get times to turn the display on or off
     on_off_times = read_config()
     if verbose >= 1:
-        print("On-Off times %s" % repr(on_off_times))
-
-    # ==== Set up PIR ====
-    if args.p:
-        import RPi.GPIO as GPIO
-
-        # Tell GPIO library to use GPIO references
-        GPIO.setmode(GPIO.BCM)
-        sw = PIR_SENSE
-        GPIO.setup(sw,GPIO.IN)
+        print("On-Off times %s" % repr(on_off_times.periods))
+    if args.node:
+        node = SyncNode(args.node, args.node_group, args.node_first, args.m)
+    # The PIRs themselves are set up after the first frame is lit
+    zones = read_pir_zones(args.pir_zones, args.m) if args.p else []
+    # Start with the cheerlights colour from before a restart, until a new one arrives
+    if args.e:
+        load_cheercolour()
+    startup_phase("config")
+
+    # Create NeoPixel object (or other backend) with appropriate configuration,
+    # or one for each output in the mapping file.
+    output_process = args.output_process
+    if args.outputs:
+        outputs = read_outputs(args.outputs, args.m, args.b)
+    else:
+        outputs = [Output(args.backend, make_strip(args.backend, args.m*LED_COUNT, args.b), range(args.m))]
+    if verbose >= 1:
+        for output in outputs:
+            print("Output %s: snowmen %s" % (output.name, repr(output.snowmen)))
+    startup_phase("outputs")
 
+    # Play back a recording, and exit
+    if args.replay:
+        if verbose >= 1:
+            print("Replaying %d frames over %.1f seconds" % (len(recording), recording.duration()))
         try:
-            if verbose >= 1:
-                print("Waiting for PIR to settle ...")
-
-            # Loop until PIR output is 0
-            # Time out after a second
-            c = 0
-            while c<10 and GPIO.input(sw)==1:
-                c += 1
-                time.sleep(0.1)
-
-            if verbose >= 1:
-                print("  Ready")
-
+            replay(recording, outputs)
         except KeyboardInterrupt:
-           # Interrupt while starting
-            # Reset GPIO settings
-            GPIO.cleanup()
-            sys.exit(0)
-
-    # ==== Set up MQTT connection to cheerlights ====
-    if args.e:
-        import paho.mqtt.client as paho
-        mqttstate = "disconnected"
-
-        # Channels "color", "colour" or "hex"
-        mytopic = "hex"
-
-        # Supported Colors:
-        #   red (#FF0000)
-        #   green (#008000)
-        #   blue (#0000FF)
-        #   cyan (#00FFFF)
-        #   white (#FFFFFF)
-        #   oldlace (#FDF5E6)
-        #   purple (#800080)
-        #   magenta (#FF00FF)
-        #   yellow (#FFFF00)
-        #   orange (#FFA500)
-        #   pink (#FFC0CB)
-
-        def on_message(client, userdata, message):
-            # Called if a message is received - set the color from the message text
-            global mqttstate, cheercolour
-            try:
-                cheermsg = message.payload.decode("utf-8")
-                if verbose >= 1:
-                    print("Cheercolour = %s" % cheermsg)
-                cheercolour = int(cheermsg[1:], 16)
-                if verbose >= 2:
-                    print("Cheercolour = 0x%x" % cheercolour)
-            except:
-                cheercolour = GREEN
-
-            #if verbose >= 2:
-            #    print("%s Topic %s, mid %d, Payload: %s" %
-            #          (datenow(), message.topic, message.mid, cheermsg))
-
-
-        def on_connect(client, userdata, flags, rc):
-            # Called if a connection is made
-            global mqttstate
-            if verbose >= 1:
-                print("%s Connection returned %d: %s" %
-                      (datenow(), rc, paho.connack_string(rc)))
-            mqttstate = "connected"
-            rc, mid = cheer.subscribe(mytopic, 0)
-            if verbose >= 1:
-                print("Return code from subscribe to %s = %d" % (mytopic, rc))
-
-        cheer = paho.Client()
-
-        # Set up the "message" handler
-        cheer.on_message = on_message
-        cheer.on_connect = on_connect
+            pass
+        report_recording(outputs)
+        sys.exit(0)
 
-        # Open the connection to the Cherlights server
-        rc = cheer.connect('mqtt.cheerlights.com', 1883, 60)
-        if rc != 0:
-            print("%s Error connecting to server %d: %s" %
-                  (datenow(), rc, paho.connack_string(rc)))
+    recorder = None
+    if args.record:
+        try:
+            recorder = FrameRecorder(args.record, args.m*LED_COUNT)
+        except OSError as e:
+            print("Could not create recording %s: %s" % (args.record, e))
             sys.exit(1)
 
-        # The on_connect handler subscribes, so that if connection drops
-        # and reconnects, it will subscribe again
-        cheer.loop_start()
-
-
-    # Create NeoPixel object with appropriate configuration.
-    strip = PixelStrip(args.m*LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, args.b, LED_CHANNEL)
-    # Intialize the library (must be called once before other functions).
-    strip.begin()
-
     # If timing the individual patterns ,do that and exit
     if args.time:
-        time_snowman(strip)
-        if args.p:
-            GPIO.cleanup()
+        # Check the baseline first, rather than after the whole benchmark
+        if args.time_baseline:
+            baseline = read_baseline(args.time_baseline)
+        results = benchmark(outputs, args.m)
+        if args.time_json:
+            with open(args.time_json, 'w') as f:
+                json.dump({'results': results}, f, indent=1)
+        regressions = 0
+        if args.time_baseline:
+            regressions = bench_regressions(results, baseline, args.time_tolerance / 100.0)
+            print("%d regressions against %s" % (regressions, args.time_baseline))
+        report_profile(args.profile)
+        cleanup_gpio()
+        sys.exit(1 if regressions else 0)
+
+    # Run everything as tasks on one asyncio event loop, rather than threads
+    if args.asyncio:
+        # Only loaded for --asyncio, so startup doesn't pay for it
+        import asyncio
+        try:
+            asyncio.run(main_async(outputs, zones, recorder))
+        except KeyboardInterrupt:
+            pass
+        if recorder is not None:
+            recorder.close()
+        report_recording(outputs)
+        report_profile(args.profile)
+        cleanup_gpio()
         sys.exit(0)
 
+    # Control commands can use the gate, so make it before they can arrive
+    gate = SyncGate(args.m)
+
+    # The compositor thread is the only thing that calls strip.show()
+    compositor = Compositor(outputs, args.m)
+    compositor.recorder = recorder
+    compositor.start()
+    if not (args.q or args.o):
+        first_light(compositor)
+    if args.control:
+        start_control(args.control, compositor)
+    start_background(zones)
+
     # === Main Loop ===
     threadlist = []
     try:
         # Start the individual snowmen
         for snowman in range(args.m):
-            x = threading.Thread(target=run_snowman, args=(snowman,strip,))
+            x = clock.Thread(target=snowman_thread, args=(snowman,compositor.frame(snowman),))
             #x.daemon = True
             x.start()
             threadlist.append(x)
-            time.sleep(0.1)
+        startup_phase("snowmen started")
 
         # All snowmen now doing their own thing. Now, periodically set a flag so that all
         # of them stop what they are doing, and a single thread controls all of them.
         # Then it switches back to individual snowmen for another period.
         # maxlcount is the approx number of seconds before we do synchronized display.
-        maxlcount = args.l
-        nummen = len(threadlist)
-        while threading.active_count() > 1:
+        # A follower waits for the coordinator to ask for each display
+        maxlcount = args.l if node is None or node.coordinator else float('inf')
+        while snowmen_running(threadlist) and not clock.finished():
             lcount = 0
             while lcount < maxlcount:
-                if threading.active_count() == 1:
+                if not snowmen_running(threadlist) or clock.finished():
+                    break
+                if sync_request.wait(1):
+                    # Asked for by --control
                     break
-                time.sleep(1)
                 lcount += 1
+                if on_off_times.refresh():
+                    # Wake any snowmen sleeping through an off period
+                    gate.wake()
+            if clock.finished():
+                break
+            sync_request.clear()
+            if node is not None and not (stream is not None and stream.active):
+                node.announce()
             # Wait for all snowmen to go idle
             if verbose >= 2:
                 print("Wait for all snowmen to be idle")
-            idlemen = 0
-            insync = True
-            while idlemen < nummen:
-                if verbose >= 2:
-                    print("Wait for insync, %d idle of %d" % (idlemen, nummen))
-                if threading.active_count() == 1:
-                    break
-                time.sleep(1)
-
-            # All idle and still running - do some funky stuff
-            if threading.active_count() > 1:
+            if gate.enter():
+                # All idle and still running - do some funky stuff
                 if verbose >= 2:
                     print("All snowmen idle - do centralised display")
-                all_snowmen_run(strip)
+                node_display(compositor)
 
             # All done - revert to out-of-sync
-            idlemen = 0
-            insync = False
+            gate.leave()
             if verbose >= 2:
                 print("Out of sync")
 
@@ -910,7 +3657,32 @@ if __name__ == '__main__':
         # Don't do anything with KbdInt, just fall off try/catch and do the "finally" caluse to shut down
         pass
     finally:
-        pass
+        # Tell the snowmen to finish. A simulation waits for them, so that
+        # their last frames are counted.
+        stopping.set()
+        gate.leave()
+        if args.simulate:
+            for x in threadlist:
+                x.join()
+        # Make sure the last frames written by the snowmen get to the strip
+        compositor.stop()
+        if recorder is not None:
+            recorder.close()
+        if args.simulate:
+            hours = clock.monotonic() / 3600.0
+            print("Simulated %s to %s in %.1f seconds" %
+                  (clock.start.strftime("%T"), clock.now().strftime("%T"), time.perf_counter() - realstart))
+            print("%d frames, %.0f frames per simulated hour, %d unchanged frames suppressed" %
+                  (compositor.shows, compositor.shows / hours if hours else 0, compositor.suppressed))
+            if verbose >= 1:
+                print("   shows suppressed skipped  jitter(ms) mean    max  pattern")
+                for name in sorted(pattern_stats):
+                    stats = pattern_stats[name]
+                    print("  %6d     %6d  %6d         %7.2f %7.2f  %s" %
+                          (stats.shows, stats.suppressed, stats.skipped,
+                           stats.jitter_mean()*1000, stats.jitter_max*1000, name))
+        report_recording(outputs)
+        report_profile(args.profile)
         #for x in threadlist:
         #    x.stop()
 
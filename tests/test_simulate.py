@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SNOWRGB = os.path.join(os.path.dirname(HERE), 'snowrgb.py')
+CFGFILE = '/home/pi/snowrgb.cfg'
+
+
+class SimulateTest(unittest.TestCase):
+    @unittest.skipIf(os.path.exists(CFGFILE), "needs the default schedule (no %s)" % CFGFILE)
+    def test_motion_in_off_time(self):
+        # 23:00-23:30 is outside the default on periods. The fake PIR sees
+        # motion, which must not keep the snowmen awake
+        result = subprocess.run([sys.executable, SNOWRGB, '--simulate', '23:00-23:30',
+                                 '-m', '2', '-q', '-p', '--gpio', 'fake'],
+                                capture_output=True, text=True, timeout=30)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Simulated 23:00:00 to 23:30:00", result.stdout)
+
+    def test_off_sends_black(self):
+        # The LEDs may be lit from an earlier run, so --off must send a
+        # frame even though it is all black
+        result = subprocess.run([sys.executable, SNOWRGB, '--off', '--backend', 'record', '-v', '-m', '2'],
+                                capture_output=True, text=True, timeout=30)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertRegex(result.stdout, r"recorded [1-9]\d* frames")
+
+
+if __name__ == '__main__':
+    unittest.main()